@@ -1,86 +1,436 @@
 # @file calculate_average_coverage.py
 # This script will return the average coverage of the target region.
 # It expects two inputs:
-# -b/--bedfile  A BED file containing the targeted regions (e.g. probes)
+# -b/--bedfile  A BED file containing the targeted regions (e.g. probes).
+#               Repeat -b to evaluate several panels in the same pass; each
+#               may be given a label as -b label=path/to/targets.bed.
 # -i/--input    The coverage output generated by BEDtools genomecov, e.g.
 #               bedtools genomecov -split -dz -ibam input_file.bam -g genome.fasta > genomecov.txt
+#               Run-length bedGraph output (genomecov -bga) is accepted as well,
+#               as is a binary depth store written by SparkFuse_Depth_Store.py.
+#
+# Many samples can be processed at once by passing -m/--manifest, a file
+# listing one genomecov file per line (optionally preceded by a sample
+# name and a tab), instead of -i. The samples are spread over a process
+# pool and written to one combined table.
+#
+# With --shard each genomecov file is split by chromosome, using a byte
+# offset index stored next to it (<input>.chromidx), and the chromosomes
+# are processed in parallel as well.
 # 
-# The script also REQUIRES that the 'bedtools' executable be in the 
-# $PATH for shell/subprocess calls to it.
+# The target regions are merged and intersected with the coverage in
+# process.
 
 import os
 import numpy
 import argparse
 import numpy
-import subprocess
+import multiprocessing
+
+from SparkFuse_Genomecov_Reader import (GenomecovReader, detect_format,
+    load_chromosome_index, split_by_chromosome)
+from SparkFuse_Manifest import read_manifest
+from SparkFuse_Depth_Store import DepthStore, is_depth_store
+
+"""
+Reads the regions of a BED file and merges them into sorted,
+non-overlapping intervals, the same way `bedtools sort | bedtools merge`
+would (overlapping and book-ended regions are joined). Returns a dict
+mapping each chromosome to a pair of numpy arrays (starts, ends) in
+BED half-open coordinates. Memory is bounded by the number of regions.
+"""
+def merge_bed_intervals(filepath):
+    regions = {}
+    with open(filepath, 'r') as filein:
+        for line in filein:
+            line = line.strip()
+            if len(line) and not line.startswith(('#', 'track', 'browser')):
+                line = line.split('\t')
+                if line[0] not in regions:
+                    regions[line[0]] = []
+                regions[line[0]].append((int(line[1]), int(line[2])))
+        filein.close()
+
+    merged = {}
+    for chromosome, pairs in regions.items():
+        pairs = numpy.array(pairs, dtype=numpy.int64)
+        order = numpy.lexsort((pairs[:, 1], pairs[:, 0]))
+        starts = pairs[order, 0]
+        ends = numpy.maximum.accumulate(pairs[order, 1])
+        # A new interval begins wherever a start lies past every end before it.
+        breaks = numpy.flatnonzero(starts[1:] > ends[:-1]) + 1
+        first = numpy.concatenate(([0], breaks))
+        last = numpy.concatenate((breaks - 1, [len(starts) - 1]))
+        merged[chromosome] = (starts[first], ends[last])
+    return merged
+    # end merge_bed_intervals()
+
+"""
+Returns the number of bases covered by a set of merged intervals
+as returned by merge_bed_intervals().
+"""
+def count_interval_bases(intervals):
+    return sum(int((ends - starts).sum()) for starts, ends in intervals.values())
+    # end count_interval_bases()
 
 """
 Returns the number of unique bases covered in the input
 BED file's regions. Overlaps only get counted once.
 """
 def get_bed_base_count(filepath):
-    command = ('bedtools sort -i {filepath} '.format(filepath=filepath) +
-        '| bedtools merge ' + 
-        '| awk \'{for(i=$2;i<$3;i++) print $1"\t"i}\' ' +
-        '| sort | uniq | wc -l')
-    proc = subprocess.Popen([command], stdout=subprocess.PIPE, shell=True)
-    resp = proc.communicate()[0].strip()
-    return int(resp)
+    return count_interval_bases(merge_bed_intervals(filepath))
     # end get_bed_base_count()
 
 """
-Converts the genomecov output into a BED format that can then be 
-filtered/processed as normal using bedtools.
+Returns, for every coordinate in x, how many bases of the merged
+intervals (starts, ends) lie below it. The overlap of a half-open run
+[a, b) with the intervals is then bases_below(b) - bases_below(a).
 """
-def genomecov_to_bed(input_filepath, output_filepath):
-    fileout = open(output_filepath, 'w')
-    with open(input_filepath, 'Ur') as filein:
-        for line in filein:
-            line = line.strip()
-            if len(line):
-                line = line.split('\t')
-                lineout = [
-                    line[0],
-                    int(line[1]) - 1,
-                    line[1],
-                    line[2],
-                    '+',
-                    line[2],
-                ]
-                if lineout[1] < 0:
-                    lineout[1] = 0
-                lineout = '\t'.join([str(x) for x in lineout])
-                fileout.write('{0}\n'.format(lineout))
-        filein.close()
-    fileout.close()
-    # end genomecov_to_bed()
+def bases_below(starts, ends, x):
+    lengths = ends - starts
+    before = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    index = numpy.searchsorted(starts, x, side='right') - 1
+    clipped = numpy.maximum(index, 0)
+    inside = numpy.clip(x - starts[clipped], 0, lengths[clipped])
+    return numpy.where(index >= 0, before[clipped] + inside, 0)
+    # end bases_below()
+
+"""
+Keeps running statistics of per-base depth in constant memory: the
+depth sum, the base count and a fixed-size histogram of depths. Depths
+above max_depth are summed exactly but share the last histogram bin,
+so percentiles above max_depth are reported as max_depth.
+"""
+class CoverageAccumulator(object):
+    def __init__(self, max_depth=65535):
+        self.max_depth = max_depth
+        self.histogram = numpy.zeros(max_depth + 1, dtype=numpy.int64)
+        self.depth_sum = 0
+        self.bases = 0
+        # end .__init__()
+
+    def add(self, depth, count=1):
+        self.histogram[min(depth, self.max_depth)] += count
+        self.depth_sum += depth * count
+        self.bases += count
+        # end .add()
+
+    def add_depths(self, depths, counts=None):
+        if not len(depths):
+            return
+        bins = numpy.minimum(depths, self.max_depth)
+        histogram = numpy.bincount(bins, weights=counts, minlength=self.max_depth + 1)
+        self.histogram += histogram.astype(numpy.int64)
+        if counts is None:
+            self.depth_sum += int(depths.sum())
+            self.bases += len(depths)
+        else:
+            self.depth_sum += int((depths * counts).sum())
+            self.bases += int(counts.sum())
+        # end .add_depths()
+
+    def add_zeros(self, count):
+        if count > 0:
+            self.add(0, count)
+        # end .add_zeros()
+
+    def merge(self, other):
+        self.histogram += other.histogram
+        self.depth_sum += other.depth_sum
+        self.bases += other.bases
+        # end .merge()
+
+    def mean(self):
+        if not self.bases:
+            return 0.0
+        return float(self.depth_sum) / self.bases
+        # end .mean()
+
+    def percentile(self, percent):
+        # Nearest-rank percentile read off the cumulative histogram.
+        if not self.bases:
+            return 0
+        rank = max(1, int(numpy.ceil(percent / 100.0 * self.bases)))
+        return int(numpy.searchsorted(numpy.cumsum(self.histogram), rank))
+        # end .percentile()
+
+    def median(self):
+        return self.percentile(50)
+        # end .median()
+
+    def fraction_at_least(self, depth):
+        if not self.bases:
+            return 0.0
+        return float(self.histogram[min(depth, self.max_depth):].sum()) / self.bases
+        # end .fraction_at_least()
+
+    def fold_80_penalty(self):
+        # Fold over-coverage needed to bring 80% of bases up to the mean.
+        # Undefined when more than 20% of the bases are uncovered.
+        p20 = self.percentile(20)
+        if not p20:
+            return None
+        return self.mean() / p20
+        # end .fold_80_penalty()
+
+    # end CoverageAccumulator class definition.
+
+"""
+Reads a target BED file into a panel: a (label, targets, bases) tuple
+holding the merged intervals (see merge_bed_intervals()) and the number
+of unique bases they cover.
+"""
+def load_panel(label, filepath):
+    targets = merge_bed_intervals(filepath)
+    return label, targets, count_interval_bases(targets)
+    # end load_panel()
 
 """
-Acts as a wrapper around bedtools intersect commands.
+Returns the coverage input format of a file: 'store' for a binary depth
+store, otherwise the genomecov format given or, for 'auto', detected.
 """
-def intersect_bed(inputA, inputB, output):
-    command = 'bedtools intersect -a {fileA} -b {fileB} > {output}'.format(
-        fileA=inputA,
-        fileB=inputB,
-        output=output,
-        )
-    resp = subprocess.Popen([command], stdout=subprocess.PIPE, shell=True).communicate()[0]
-    # end intersect_bed()
+def resolve_format(input_filepath, format='auto'):
+    if is_depth_store(input_filepath):
+        return 'store'
+    if format == 'auto':
+        return detect_format(input_filepath)
+    return format
+    # end resolve_format()
 
+"""
+Adds the in-target depth of each panel to that panel's accumulator by
+slicing the merged target intervals straight out of a depth store, so
+only the target bases are read.
+"""
+def accumulate_store_coverage(store_filepath, panels, accumulators):
+    store = DepthStore(store_filepath)
+    for (label, targets, bases), accumulator in zip(panels, accumulators):
+        for chromosome, (starts, ends) in targets.items():
+            if chromosome not in store:
+                continue
+            depth = store.depth(chromosome)
+            ends = numpy.minimum(ends, len(depth))
+            pieces = [depth[start:end] for start, end in zip(starts.tolist(), ends.tolist())
+                if start < end]
+            if len(pieces):
+                accumulator.add_depths(numpy.concatenate(pieces).astype(numpy.int64))
+    return accumulators
+    # end accumulate_store_coverage()
+
+"""
+Adds the genomecov depth of every in-target base of each panel to that
+panel's accumulator, all in a single pass over the coverage. Each batch
+of coverage runs (one base long for 'dz' input) is overlapped with the
+merged target intervals by interval arithmetic, so no intermediate BED
+files or bedtools calls are needed. Targeted bases absent from the
+genomecov output are not added here; see CoverageAccumulator.add_zeros().
+A byte_range limits the pass to part of the file (see
+load_chromosome_index()).
+"""
+def accumulate_in_target_coverage(input_filepath, panels, accumulators, format='dz',
+        byte_range=None):
+    if format == 'store':
+        return accumulate_store_coverage(input_filepath, panels, accumulators)
+    reader = GenomecovReader(input_filepath, format=format, byte_range=byte_range)
+    for chromosome_ids, starts, ends, depths in reader.runs():
+        for code, lo, hi in split_by_chromosome(chromosome_ids):
+            chromosome = reader.chromosomes[code]
+            for (label, targets, bases), accumulator in zip(panels, accumulators):
+                if chromosome not in targets:
+                    continue
+                target_starts, target_ends = targets[chromosome]
+                overlap = (bases_below(target_starts, target_ends, ends[lo:hi]) -
+                    bases_below(target_starts, target_ends, starts[lo:hi]))
+                inside = overlap > 0
+                accumulator.add_depths(depths[lo:hi][inside], overlap[inside])
+    return accumulators
+    # end accumulate_in_target_coverage()
+
+"""
+Returns one CoverageAccumulator per panel over every base of its targets
+for one genomecov file, with uncovered target bases counted as zero depth.
+"""
+def target_coverage(input_filepath, panels, format='dz', max_depth=65535):
+    format = resolve_format(input_filepath, format)
+    accumulators = [CoverageAccumulator(max_depth) for panel in panels]
+    accumulate_in_target_coverage(input_filepath, panels, accumulators, format)
+    for (label, targets, bases), accumulator in zip(panels, accumulators):
+        accumulator.add_zeros(bases - accumulator.bases)
+    return accumulators
+    # end target_coverage()
+
+# Read-only state shared by the worker processes; the target intervals
+# are built once and handed to each worker when it starts.
+_worker_state = {}
+
+def _init_worker(panels, max_depth):
+    _worker_state['panels'] = panels
+    _worker_state['max_depth'] = max_depth
+    # end _init_worker()
+
+def _coverage_worker(job):
+    # Partial sums only, tagged with the sample they belong to; the caller
+    # merges them and adds the zeros.
+    owner, input_filepath, format, byte_range = job
+    panels = _worker_state['panels']
+    accumulators = [CoverageAccumulator(_worker_state['max_depth']) for panel in panels]
+    accumulate_in_target_coverage(input_filepath, panels, accumulators, format, byte_range)
+    return owner, accumulators
+    # end _coverage_worker()
+
+"""
+Computes panel coverage for many (name, filepath) samples over a pool of
+worker processes, returning (name, accumulators) pairs in sample order.
+With shard set, each file is split by chromosome using its byte-offset
+index (built on first use) and the shards of every sample are spread
+over the pool, so a single sample also uses every worker. Chromosomes
+outside all panels are skipped. Partial results are merged into their
+sample's accumulators as they arrive, so only one set per sample is held.
+"""
+def batch_target_coverage(samples, panels, format='dz', max_depth=65535, processes=None,
+        shard=False):
+    initargs = (panels, max_depth)
+    if processes == 1:
+        _init_worker(*initargs)
+        pool = None
+        run = lambda worker, jobs: [worker(job) for job in jobs]
+        stream = map
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=initargs)
+        run = lambda worker, jobs: pool.map(worker, jobs, chunksize=1)
+        stream = pool.imap_unordered
+
+    try:
+        formats = [resolve_format(x[1], format) for x in samples]
+        indexes = [[(None, None)] for sample in samples]
+        if shard:
+            # Depth stores are read by target range and need no sharding.
+            text = [i for i, x in enumerate(formats) if x != 'store']
+            for i, index in zip(text, run(load_chromosome_index, [samples[i][1] for i in text])):
+                indexes[i] = index
+
+        jobs = []
+        for i, (name, input_filepath) in enumerate(samples):
+            for entry in indexes[i]:
+                if entry[0] is not None:
+                    if not any(entry[0] in panel[1] for panel in panels):
+                        continue
+                    byte_range = (entry[1], entry[2])
+                else:
+                    byte_range = None
+                jobs.append((i, input_filepath, formats[i], byte_range))
+
+        totals = [[CoverageAccumulator(max_depth) for panel in panels] for sample in samples]
+        for owner, partial in stream(_coverage_worker, jobs):
+            for accumulator, part in zip(totals[owner], partial):
+                accumulator.merge(part)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = []
+    for (name, input_filepath), accumulators in zip(samples, totals):
+        for (label, targets, bases), accumulator in zip(panels, accumulators):
+            accumulator.add_zeros(bases - accumulator.bases)
+        results.append((name, accumulators))
+    return results
+    # end batch_target_coverage()
+
+"""
+Writes the coverage statistics of one or more accumulators as a
+tab-delimited table with a header line. Each row is a (labels,
+accumulator) pair, where labels fill the label_names columns. Without
+metrics only the integer average coverage is written per row.
+"""
+def write_coverage_table(filepath, rows, thresholds, label_names=(), metrics=True):
+    if not metrics:
+        with open(filepath, 'w') as fileout:
+            header = list(label_names) + ['AVERAGE_COVERAGE']
+            fileout.write('{0}\n'.format('\t'.join(header)))
+            for labels, accumulator in rows:
+                row = list(labels) + [int(accumulator.mean())]
+                fileout.write('{0}\n'.format('\t'.join([str(x) for x in row])))
+            fileout.close()
+        return
+
+    header = list(label_names) + [
+        'MEAN_TARGET_COVERAGE',
+        'MEDIAN_TARGET_COVERAGE',
+        'P10_TARGET_COVERAGE',
+        'P25_TARGET_COVERAGE',
+        'P75_TARGET_COVERAGE',
+        'P90_TARGET_COVERAGE',
+        ]
+    header += ['PCT_TARGET_BASES_{0}X'.format(x) for x in thresholds]
+    header.append('FOLD_80_BASE_PENALTY')
+
+    with open(filepath, 'w') as fileout:
+        fileout.write('{0}\n'.format('\t'.join(header)))
+        for labels, accumulator in rows:
+            penalty = accumulator.fold_80_penalty()
+            row = list(labels) + [
+                '{0:.2f}'.format(accumulator.mean()),
+                accumulator.median(),
+                accumulator.percentile(10),
+                accumulator.percentile(25),
+                accumulator.percentile(75),
+                accumulator.percentile(90),
+                ]
+            row += ['{0:.4f}'.format(accumulator.fraction_at_least(x)) for x in thresholds]
+            row.append('NA' if penalty is None else '{0:.2f}'.format(penalty))
+            fileout.write('{0}\n'.format('\t'.join([str(x) for x in row])))
+        fileout.close()
+    # end write_coverage_table()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-i', '--input', dest='input', type=str,
         help='Input (coverage data) filepath.')
-    parser.add_argument('-b', '--bedfile', dest='bedfile', type=str,
-        help='Target regions BED file.')
+    parser.add_argument('-m', '--manifest', dest='manifest', type=str,
+        help='Batch mode: file listing one genomecov filepath per line, '
+        'optionally preceded by a sample name and a tab.')
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=None,
+        help='Worker processes for batch or --shard mode (default: one per CPU).')
+    parser.add_argument('--shard', dest='shard', action='store_true',
+        help='Process each coverage file by chromosome in parallel, using a '
+        'byte-offset index kept next to it (built on first use).')
+    parser.add_argument('-b', '--bedfile', dest='bedfiles', type=str, action='append',
+        help='Target regions BED file, optionally as label=path. Repeat '
+        'for several target panels.')
     parser.add_argument('-o', '--output', dest='output', type=str,
         help='Output filepath.')
+    parser.add_argument('--format', dest='format', default='auto',
+        choices=['auto', 'dz', 'bga'],
+        help='Coverage input format: per-base genomecov -dz or run-length '
+        'genomecov -bga/bedGraph (default: detected from the input).')
+    parser.add_argument('--metrics', dest='metrics', action='store_true',
+        help='Write a table of mean, median, percentile, depth threshold '
+        'and fold-80 penalty metrics instead of the average alone.')
+    parser.add_argument('--thresholds', dest='thresholds', type=str,
+        default='1,10,20,30,50,100',
+        help='Comma-separated depths reported as PCT_TARGET_BASES_<N>X '
+        'with --metrics (default: %(default)s).')
+    parser.add_argument('--max-depth', dest='max_depth', type=int, default=65535,
+        help='Depths above this share the last histogram bin (default: %(default)s).')
 
     args = parser.parse_args()
 
-    if args.input is None:
+    if args.manifest is not None:
+        if args.input is not None:
+            print('Error: Specify either an input file or a manifest, not both!')
+            exit()
+        manifest_filepath = os.path.abspath(args.manifest)
+        if not os.path.isfile(manifest_filepath):
+            print('Error: {0} does not exist!'.format(manifest_filepath))
+            exit()
+        samples = read_manifest(manifest_filepath)
+        for name, input_filepath in samples:
+            if not os.path.isfile(input_filepath):
+                print('Error: {0} does not exist!'.format(input_filepath))
+                exit()
+    elif args.input is None:
         print('Error: Input file must be specified!')
         exit()
     else:
@@ -89,14 +439,24 @@ if __name__ == '__main__':
             print('Error: {0} does not exist!'.format(input_filepath))
             exit()
 
-    if args.bedfile is None:
+    if args.bedfiles is None:
         print('Error: BED file must be specified!')
         exit()
     else:
-        bedfile_filepath = os.path.abspath(args.bedfile)
-        if not os.path.isfile(bedfile_filepath):
-            print('Error: {0} does not exist!'.format(bedfile_filepath))
-            exit()                
+        bedfiles = []
+        for bedfile in args.bedfiles:
+            if '=' in bedfile and not os.path.isfile(bedfile):
+                label, bedfile = bedfile.split('=', 1)
+            else:
+                label = os.path.splitext(os.path.basename(bedfile))[0]
+            bedfile_filepath = os.path.abspath(bedfile)
+            if not os.path.isfile(bedfile_filepath):
+                print('Error: {0} does not exist!'.format(bedfile_filepath))
+                exit()
+            if label in [x[0] for x in bedfiles]:
+                print('Error: Panel label {0} is used more than once!'.format(label))
+                exit()
+            bedfiles.append((label, bedfile_filepath))
 
 
     if args.output is None:
@@ -108,35 +468,38 @@ if __name__ == '__main__':
 
     # Get the count of targeted bases so the average can be adjusted
     # accordingly in case not every base was covered.
-    in_target_bases = get_bed_base_count(bedfile_filepath)
+    panels = [load_panel(label, bedfile_filepath) for label, bedfile_filepath in bedfiles]
 
-    # Filter the genomecov output to get only in-target values.
-    coverage_bedfile = input_filepath + '.bed'
-    genomecov_to_bed(input_filepath, coverage_bedfile)
-    in_target_coverage = input_filepath + '.in_target'
-    intersect_bed(coverage_bedfile, bedfile_filepath, in_target_coverage)
+    thresholds = [int(x) for x in args.thresholds.split(',') if len(x.strip())]
 
-    values = []
-    bases = 0
-    with open(in_target_coverage, 'Ur') as filein:
-        for line in filein:
-            if len(line):
-                line = line.split('\t')
-                values.append(int(float(line[3])))
-                bases += 1
-        filein.close()
+    # Accumulate the in-target depth straight from the genomecov stream.
+    # Any targeted base missing from the genomecov output had zero
+    # coverage, so the remainder of each panel is added as zeros.
+    if args.manifest is not None:
+        results = batch_target_coverage(samples, panels, args.format,
+            args.max_depth, args.processes, args.shard)
+        rows = []
+        for name, accumulators in results:
+            for panel, accumulator in zip(panels, accumulators):
+                rows.append(((name, panel[0]), accumulator))
+        write_coverage_table(output_filepath, rows, thresholds, ('Sample', 'Panel'), args.metrics)
+        exit()
 
-    # If any bases weren't coverered, add the zero-coverage values to
-    # get the correct per-base coverage value.
-    if bases < in_target_bases:
-        values += [0] * (in_target_bases - bases)
+    if args.shard:
+        sample = (os.path.basename(input_filepath), input_filepath)
+        accumulators = batch_target_coverage([sample], panels, args.format,
+            args.max_depth, args.processes, True)[0][1]
+    else:
+        accumulators = target_coverage(input_filepath, panels, args.format, args.max_depth)
 
     # Write out the output
-    fileout = open(output_filepath, 'w')
-    average = int(numpy.mean(values))
-    fileout.write('{0}\n'.format(average))
-    fileout.close()
-
-    # Delete intermediate files
-    os.remove(coverage_bedfile)
-    os.remove(in_target_coverage)
+    if len(panels) > 1:
+        rows = [((panel[0],), accumulator) for panel, accumulator in zip(panels, accumulators)]
+        write_coverage_table(output_filepath, rows, thresholds, ('Panel',), args.metrics)
+    elif args.metrics:
+        write_coverage_table(output_filepath, [((), accumulators[0])], thresholds)
+    else:
+        fileout = open(output_filepath, 'w')
+        average = int(accumulators[0].mean())
+        fileout.write('{0}\n'.format(average))
+        fileout.close()
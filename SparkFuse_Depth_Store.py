@@ -0,0 +1,387 @@
+# @file depth_store.py
+#
+# Converts BEDtools genomecov output (per-base -dz or run-length -bga) into
+# a compact binary depth store that the coverage scripts can read without
+# re-parsing any text:
+#     python SparkFuse_Depth_Store.py -i genomecov.txt -o sample.depth
+#
+# The store is one file: an 8-byte magic string, a 4-byte little-endian
+# header length and a small JSON header listing every chromosome's length
+# and data offset, followed by one fixed-width unsigned integer array per
+# chromosome. Element i of a chromosome's array holds the depth at 1-based
+# position i + 1. Arrays are read zero-copy through numpy.memmap, so a
+# query only touches the bytes of the ranges it slices.
+#
+# A store can also carry a pyramid of binned depth sums (64bp, 1kb and
+# 16kb bins by default), kept next to it as <store>.pyramid, so that the
+# depth of any region is the sum of a few coarse bins plus its edge bases:
+#     python SparkFuse_Depth_Store.py -i sample.depth --pyramid
+#     python SparkFuse_Depth_Store.py -i sample.depth --regions genes.bed -o means.txt
+
+import os
+import sys
+import json
+import struct
+import argparse
+import numpy
+
+from SparkFuse_Genomecov_Reader import (GenomecovReader, detect_format,
+    load_chromosome_index, split_by_chromosome)
+
+MAGIC = b'SFDEPTH1'
+PYRAMID_MAGIC = b'SFPYRAM1'
+PYRAMID_SUFFIX = '.pyramid'
+DEFAULT_BIN_SIZES = (64, 1024, 16384)
+ALIGNMENT = 64
+
+# Longest run written by per-base index expansion rather than as a slice.
+EXPAND_RUN_LENGTH = 16
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+    # end _aligned()
+
+"""
+Returns True when the file at filepath starts with the depth store magic.
+"""
+def is_depth_store(filepath):
+    with open(filepath, 'rb') as filein:
+        magic = filein.read(len(MAGIC))
+        filein.close()
+    return magic == MAGIC
+    # end is_depth_store()
+
+"""
+Returns the last coordinate covered by each chromosome of a genomecov
+file (the 1-based position for 'dz', the run end for 'bga'), read from
+the final line of each chromosome's byte range.
+"""
+def _chromosome_lengths(filepath, format):
+    lengths = []
+    with open(filepath, 'rb') as filein:
+        for chromosome, start, end in load_chromosome_index(filepath):
+            filein.seek(max(start, end - 4096))
+            lines = [x for x in filein.read(end - filein.tell()).split(b'\n') if len(x.strip())]
+            column = 1 if format == 'dz' else 2
+            lengths.append((chromosome, int(lines[-1].split(b'\t')[column])))
+        filein.close()
+    return lengths
+    # end _chromosome_lengths()
+
+"""
+Writes a depth store for a genomecov file. Depths above the maximum of
+dtype are clipped to it. Positions absent from the genomecov output are
+stored as zero depth.
+"""
+def write_depth_store(input_filepath, store_filepath, format='auto', dtype='uint32'):
+    if format == 'auto':
+        format = detect_format(input_filepath)
+    dtype = numpy.dtype(dtype)
+    limit = numpy.iinfo(dtype).max
+
+    # Offsets are relative to the start of the data, which follows the
+    # header padded to ALIGNMENT bytes.
+    chromosomes = []
+    offset = 0
+    for chromosome, length in _chromosome_lengths(input_filepath, format):
+        chromosomes.append([chromosome, length, offset])
+        offset += _aligned(length * dtype.itemsize)
+    header = json.dumps({'dtype': dtype.name, 'chromosomes': chromosomes}).encode()
+    data_offset = _aligned(len(MAGIC) + 4 + len(header))
+
+    with open(store_filepath, 'wb') as fileout:
+        fileout.write(MAGIC)
+        fileout.write(struct.pack('<I', len(header)))
+        fileout.write(header)
+        fileout.truncate(data_offset + offset)
+        fileout.close()
+    if not offset:
+        return store_filepath
+
+    data = numpy.memmap(store_filepath, dtype=dtype, mode='r+', offset=data_offset,
+        shape=(offset // dtype.itemsize,))
+    bases = {}
+    for chromosome, length, start in chromosomes:
+        bases[chromosome] = start // dtype.itemsize
+
+    reader = GenomecovReader(input_filepath, format=format)
+    for chromosome_ids, starts, ends, depths in reader.runs():
+        for code, lo, hi in split_by_chromosome(chromosome_ids):
+            base = bases[reader.chromosomes[code]]
+            covered = depths[lo:hi] > 0
+            run_starts = starts[lo:hi][covered]
+            run_lengths = ends[lo:hi][covered] - run_starts
+            values = numpy.minimum(depths[lo:hi][covered], limit)
+            # Short runs (every 'dz' record) are expanded into one index per
+            # base and written in one go; long runs are assigned as slices,
+            # so memory stays bounded by the chunk, not the bases covered.
+            short = run_lengths <= EXPAND_RUN_LENGTH
+            lengths = run_lengths[short]
+            first = numpy.repeat(run_starts[short] - (numpy.cumsum(lengths) - lengths), lengths)
+            data[base + first + numpy.arange(int(lengths.sum()))] = numpy.repeat(values[short], lengths)
+            for start, length, value in zip(run_starts[~short].tolist(), run_lengths[~short].tolist(),
+                    values[~short].tolist()):
+                data[base + start:base + start + length] = value
+    data.flush()
+    del data
+    return store_filepath
+    # end write_depth_store()
+
+"""
+Read-only view of a depth store. depth(chromosome) returns the memory
+mapped per-base depth array of a chromosome, indexed by 0-based
+position; slicing it only reads the pages it touches.
+"""
+class DepthStore(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as filein:
+            if filein.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{0} is not a depth store.'.format(filepath))
+            length = struct.unpack('<I', filein.read(4))[0]
+            header = json.loads(filein.read(length).decode())
+            filein.close()
+        data_offset = _aligned(len(MAGIC) + 4 + length)
+        self.dtype = numpy.dtype(header['dtype'])
+        self.chromosomes = [x[0] for x in header['chromosomes']]
+        self.lengths = {}
+        self.arrays = {}
+        size = os.path.getsize(filepath) - data_offset
+        if size > 0:
+            data = numpy.memmap(filepath, dtype=self.dtype, mode='r', offset=data_offset,
+                shape=(size // self.dtype.itemsize,))
+        else:
+            data = numpy.zeros(0, dtype=self.dtype)
+        for chromosome, length, offset in header['chromosomes']:
+            start = offset // self.dtype.itemsize
+            self.lengths[chromosome] = length
+            self.arrays[chromosome] = data[start:start + length]
+        # end .__init__()
+
+    def depth(self, chromosome):
+        return self.arrays[chromosome]
+        # end .depth()
+
+    def __contains__(self, chromosome):
+        return chromosome in self.arrays
+        # end .__contains__()
+
+    # end DepthStore class definition.
+
+def _store_stamp(store_filepath):
+    # (size, modification time in ns) of a store, recorded in its pyramid.
+    stat = os.stat(store_filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+    # end _store_stamp()
+
+"""
+Writes the binned depth sums of a depth store as a pyramid file, one
+uint64 array per chromosome and bin size. Each bin size must be a
+multiple of the one before it, as each level is summed from the last.
+The header records the store's size and modification time, so that a
+pyramid left over from an earlier store can be detected.
+"""
+def write_depth_pyramid(store_filepath, pyramid_filepath=None, bin_sizes=DEFAULT_BIN_SIZES):
+    if pyramid_filepath is None:
+        pyramid_filepath = store_filepath + PYRAMID_SUFFIX
+    bin_sizes = sorted(bin_sizes)
+    for smaller, larger in zip(bin_sizes[:-1], bin_sizes[1:]):
+        if larger % smaller:
+            raise ValueError('Bin size {0} is not a multiple of {1}.'.format(larger, smaller))
+
+    store = DepthStore(store_filepath)
+    levels = []
+    offset = 0
+    for chromosome in store.chromosomes:
+        sizes = []
+        for bin_size in bin_sizes:
+            count = -(-store.lengths[chromosome] // bin_size)
+            sizes.append([count, offset])
+            offset += _aligned(count * 8)
+        levels.append([chromosome, sizes])
+    header = json.dumps({'bin_sizes': bin_sizes, 'store': _store_stamp(store_filepath),
+        'chromosomes': levels}).encode()
+    data_offset = _aligned(len(PYRAMID_MAGIC) + 4 + len(header))
+
+    with open(pyramid_filepath, 'wb') as fileout:
+        fileout.write(PYRAMID_MAGIC)
+        fileout.write(struct.pack('<I', len(header)))
+        fileout.write(header)
+        fileout.truncate(data_offset)
+        fileout.seek(data_offset)
+        for chromosome, sizes in levels:
+            depth = store.depth(chromosome)
+            sums = None
+            for bin_size, (count, start) in zip(bin_sizes, sizes):
+                if sums is None:
+                    # Finest level: whole bins are summed straight off the
+                    # memory map, the partial last bin separately.
+                    whole = len(depth) // bin_size
+                    sums = numpy.zeros(count, dtype=numpy.uint64)
+                    sums[:whole] = depth[:whole * bin_size].reshape(whole, bin_size).sum(
+                        axis=1, dtype=numpy.uint64)
+                    if whole < count:
+                        sums[whole] = depth[whole * bin_size:].sum(dtype=numpy.uint64)
+                else:
+                    factor = bin_size // previous
+                    padded = numpy.zeros(count * factor, dtype=numpy.uint64)
+                    padded[:len(sums)] = sums
+                    sums = padded.reshape(count, factor).sum(axis=1)
+                previous = bin_size
+                fileout.seek(data_offset + start)
+                fileout.write(sums.astype('<u8').tobytes())
+        fileout.truncate(data_offset + offset)
+        fileout.close()
+    return pyramid_filepath
+    # end write_depth_pyramid()
+
+def pyramid_is_current(store_filepath, pyramid_filepath=None):
+    # Whether the pyramid exists and was written for the store as it is now.
+    if pyramid_filepath is None:
+        pyramid_filepath = store_filepath + PYRAMID_SUFFIX
+    if not os.path.isfile(pyramid_filepath):
+        return False
+    with open(pyramid_filepath, 'rb') as filein:
+        if filein.read(len(PYRAMID_MAGIC)) != PYRAMID_MAGIC:
+            return False
+        length = struct.unpack('<I', filein.read(4))[0]
+        header = json.loads(filein.read(length).decode())
+        filein.close()
+    return header.get('store') == _store_stamp(store_filepath)
+    # end pyramid_is_current()
+
+"""
+Answers region depth queries against a depth store and its pyramid
+(see write_depth_pyramid()). A pyramid that does not match the store's
+current size and modification time is rejected as stale. A region sum reads whole bins from the
+coarsest level that fits and only drops to finer levels, and finally to
+single bases, for the region's ragged edges.
+"""
+class DepthPyramid(object):
+    def __init__(self, store_filepath, pyramid_filepath=None):
+        if pyramid_filepath is None:
+            pyramid_filepath = store_filepath + PYRAMID_SUFFIX
+        self.store = DepthStore(store_filepath)
+        with open(pyramid_filepath, 'rb') as filein:
+            if filein.read(len(PYRAMID_MAGIC)) != PYRAMID_MAGIC:
+                raise ValueError('{0} is not a depth pyramid.'.format(pyramid_filepath))
+            length = struct.unpack('<I', filein.read(4))[0]
+            header = json.loads(filein.read(length).decode())
+            filein.close()
+        if header.get('store') != _store_stamp(store_filepath):
+            raise ValueError('{0} is stale: {1} has changed since it was written.'.format(
+                pyramid_filepath, store_filepath))
+        data_offset = _aligned(len(PYRAMID_MAGIC) + 4 + length)
+        size = os.path.getsize(pyramid_filepath) - data_offset
+        if size > 0:
+            data = numpy.memmap(pyramid_filepath, dtype='<u8', mode='r', offset=data_offset,
+                shape=(size // 8,))
+        else:
+            data = numpy.zeros(0, dtype='<u8')
+
+        self.bin_sizes = header['bin_sizes']
+        self.levels = {}
+        for chromosome, sizes in header['chromosomes']:
+            self.levels[chromosome] = [data[start // 8:start // 8 + count]
+                for count, start in sizes]
+        # end .__init__()
+
+    def _sum(self, chromosome, start, end, level):
+        if start >= end:
+            return 0
+        if level < 0:
+            return int(self.store.depth(chromosome)[start:end].sum(dtype=numpy.uint64))
+        bin_size = self.bin_sizes[level]
+        first = -(-start // bin_size)
+        last = end // bin_size
+        if first >= last:
+            return self._sum(chromosome, start, end, level - 1)
+        return (int(self.levels[chromosome][level][first:last].sum(dtype=numpy.uint64)) +
+            self._sum(chromosome, start, first * bin_size, level - 1) +
+            self._sum(chromosome, last * bin_size, end, level - 1))
+        # end ._sum()
+
+    def region_sum(self, chromosome, start, end):
+        # Depth summed over the 0-based, half-open region [start, end).
+        if chromosome not in self.levels:
+            return 0
+        end = min(end, self.store.lengths[chromosome])
+        return self._sum(chromosome, max(start, 0), end, len(self.bin_sizes) - 1)
+        # end .region_sum()
+
+    def region_mean(self, chromosome, start, end):
+        if end <= start:
+            return 0.0
+        return float(self.region_sum(chromosome, start, end)) / (end - start)
+        # end .region_mean()
+
+    # end DepthPyramid class definition.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Genomecov to depth store conversion')
+    parser.add_argument('-i', '--input', dest='input', type=str,
+        help='Genomecov output filepath (-dz or -bga), or an existing depth '
+        'store for --pyramid and --regions.')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+        help='Depth store output filepath, or region means output with --regions.')
+    parser.add_argument('--format', dest='format', default='auto',
+        choices=['auto', 'dz', 'bga'],
+        help='Genomecov format (default: detected from the input).')
+    parser.add_argument('--dtype', dest='dtype', default='uint32',
+        choices=['uint8', 'uint16', 'uint32'],
+        help='Stored depth width; larger depths are clipped (default: %(default)s).')
+    parser.add_argument('--pyramid', dest='pyramid', action='store_true',
+        help='Also write binned depth sums next to the store (<store>.pyramid).')
+    parser.add_argument('--bin-sizes', dest='bin_sizes', type=str,
+        default=','.join([str(x) for x in DEFAULT_BIN_SIZES]),
+        help='Comma-separated pyramid bin sizes (default: %(default)s).')
+    parser.add_argument('--regions', dest='regions', type=str,
+        help='BED file of regions to report the mean depth of, using the '
+        'store and its pyramid.')
+    args = parser.parse_args()
+
+    if args.input is None:
+        print('Error: Input file must be specified!')
+        exit(1)
+    else:
+        input_filepath = os.path.abspath(args.input)
+        if not os.path.isfile(input_filepath):
+            print('Error: {0} does not exist!'.format(input_filepath))
+            exit(1)
+
+    if args.regions is not None:
+        if not is_depth_store(input_filepath):
+            print('Error: {0} is not a depth store!'.format(input_filepath))
+            exit(1)
+        if not pyramid_is_current(input_filepath):
+            write_depth_pyramid(input_filepath,
+                bin_sizes=[int(x) for x in args.bin_sizes.split(',')])
+        pyramid = DepthPyramid(input_filepath)
+        if args.output is None:
+            fileout = sys.stdout
+        else:
+            fileout = open(os.path.abspath(args.output), 'w')
+        with open(args.regions, 'r') as filein:
+            for line in filein:
+                line = line.strip()
+                if len(line) and not line.startswith(('#', 'track', 'browser')):
+                    line = line.split('\t')
+                    mean = pyramid.region_mean(line[0], int(line[1]), int(line[2]))
+                    fileout.write('{0}\t{1:.2f}\n'.format('\t'.join(line[:4]), mean))
+            filein.close()
+        if fileout is not sys.stdout:
+            fileout.close()
+        exit(0)
+
+    if is_depth_store(input_filepath):
+        store_filepath = input_filepath
+    elif args.output is None:
+        print('Error: Output file must be specified!')
+        exit(1)
+    else:
+        store_filepath = os.path.abspath(args.output)
+        write_depth_store(input_filepath, store_filepath, args.format, args.dtype)
+
+    if args.pyramid:
+        write_depth_pyramid(store_filepath, bin_sizes=[int(x) for x in args.bin_sizes.split(',')])
@@ -6,19 +6,252 @@
 # -b/--bedfile  A BED file containing the target exons.
 # -i/--input    The coverage output generated by BEDtools genomecov, e.g.
 #               bedtools genomecov -split -dz -ibam input_file.bam -g genome.fasta > genomecov.txt
+#               Run-length bedGraph output (genomecov -bga) is accepted as well,
+#               as is a binary depth store written by SparkFuse_Depth_Store.py.
+#
+# With --shard the chromosomes of the genomecov file are loaded in parallel,
+# using a byte-offset index stored next to it (<genomecov>.chromidx).
+#
+# Cohort mode: -m/--manifest lists many genomecov files (optionally preceded
+# by a sample name and a tab). The exon model is loaded once, the samples are
+# processed by parallel workers, and one long-format table of (sample,
+# transcript, exon, mean depth) rows is written.
+#
+# --exon-metrics writes a second, long-format table with each exon's minimum
+# depth, bases below 20x/50x/100x and coefficient of variation.
+#
+# Output filepaths ending in .gz are written gzip-compressed.
+#
+# --transcript-coverage writes each transcript's mean depth and a 100-bin
+# 5'->3' coverage profile (strand from BED column 6), for RNA degradation QC.
+#
+# --genes, --transcripts and --regions restrict the exons loaded from the BED,
+# and only the matching parts of the genomecov file are then read.
+#
+# With --cache-dir the parsed exon BED is cached as flat binary arrays keyed
+# by the BED's content hash, so repeated runs on one panel skip re-parsing.
 
 import sys
 import os
 import argparse
+import contextlib
+import gc
+import gzip
+import hashlib
+import multiprocessing
 import numpy
 
+from SparkFuse_Genomecov_Reader import (GenomecovReader, detect_format,
+	find_line_offset, load_chromosome_index, split_by_chromosome)
+from SparkFuse_Manifest import read_manifest
+from SparkFuse_Depth_Store import DepthStore, is_depth_store
+
+# Number of bins of the 5'->3' transcript coverage profiles.
+PROFILE_BINS = 100
+
+# Depths below which bases are counted by the per-exon metrics.
+EXON_METRIC_THRESHOLDS = (20, 50, 100)
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Exons closer than this many bases are read from the genomecov file as one
+# span by Genome.load_coverage_indexed().
+COVERAGE_SPAN_GAP = 65536
+
+EXON_CACHE_SUFFIX = '.exons.npz'
+EXON_CACHE_VERSION = 3
+
+def open_output(filepath):
+	# Buffered text output, gzip-compressed when the filepath ends in .gz.
+	if filepath.endswith('.gz'):
+		return gzip.open(filepath, 'wt')
+	return open(filepath, 'w', buffering=OUTPUT_BUFFER_SIZE)
+	# end open_output()
+
+@contextlib.contextmanager
+def gc_paused():
+	# Exons and transcripts point at each other, so every model object is
+	# tracked by the cyclic garbage collector, whose passes over the growing
+	# heap cost more than building the model itself.
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+	# end gc_paused()
+
+def exon_file_digest(filepath):
+	digest = hashlib.sha1()
+	with open(filepath, 'rb') as filein:
+		for block in iter(lambda: filein.read(1 << 20), b''):
+			digest.update(block)
+		filein.close()
+	return digest.hexdigest()
+	# end exon_file_digest()
+
+class ExonRecords(object):
+	# The exon BED records in file order as parallel arrays. Chromosomes,
+	# genes, transcripts and strands are codes into the shared names list.
+	COLUMNS = ('chromosome', 'gene', 'transcript', 'strand', 'exon', 'start', 'end')
+
+	def __init__(self, names, columns):
+		self.names = names
+		for key in self.COLUMNS:
+			setattr(self, key, columns[key])
+		# end .__init__()
+
+	def __len__(self):
+		return len(self.exon)
+		# end .__len__()
+
+	# end ExonRecords class definition.
+
+def parse_exon_bed(filepath):
+	names = []
+	codes = {}
+	columns = dict((key, []) for key in ExonRecords.COLUMNS)
+	with open(filepath, 'r') as filein:
+		for line in filein:
+			line = line.strip()
+			if len(line):
+				line = line.split('\t')
+				gene_symbol, _, exon, transcript_id = [str(x).strip() for x in line[3].strip().split(' ')]
+				strand = line[5].strip() if len(line) > 5 else '.'
+				for key, name in (('chromosome', line[0].strip()), ('gene', gene_symbol),
+						('transcript', transcript_id), ('strand', strand)):
+					if name not in codes:
+						codes[name] = len(names)
+						names.append(name)
+					columns[key].append(codes[name])
+				columns['exon'].append(int(exon))
+				columns['start'].append(int(line[1]))
+				columns['end'].append(int(line[2]))
+			# end if len(line) block
+		# end for loop
+		filein.close()
+	for key in ('chromosome', 'gene', 'transcript', 'strand', 'exon'):
+		columns[key] = numpy.array(columns[key], dtype=numpy.int32)
+	for key in ('start', 'end'):
+		columns[key] = numpy.array(columns[key], dtype=numpy.int64)
+	return ExonRecords(names, columns)
+	# end parse_exon_bed()
+
+"""
+The exon cache is a compressed .npz of the ExonRecords columns, with the
+names list stored as one UTF-8 blob and the byte offset of each name.
+"""
+def write_exon_cache(filepath, records):
+	encoded = [name.encode('utf-8') for name in records.names]
+	offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+	offsets[1:] = numpy.cumsum([len(name) for name in encoded])
+	arrays = {
+		'version': numpy.array([EXON_CACHE_VERSION], dtype=numpy.int64),
+		'names': numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8),
+		'name_offsets': offsets,
+		}
+	for key in ExonRecords.COLUMNS:
+		arrays[key] = getattr(records, key)
+
+	# Written under a temporary name and renamed, so that concurrent runs
+	# never read a partial cache.
+	temp_filepath = '{0}.{1}.tmp'.format(filepath, os.getpid())
+	with open(temp_filepath, 'wb') as fileout:
+		numpy.savez_compressed(fileout, **arrays)
+		fileout.close()
+	os.rename(temp_filepath, filepath)
+	return True
+	# end write_exon_cache()
+
+def read_exon_cache(filepath):
+	with numpy.load(filepath, allow_pickle=False) as arrays:
+		if int(arrays['version'][0]) != EXON_CACHE_VERSION:
+			return None
+		blob = arrays['names'].tobytes()
+		offsets = arrays['name_offsets'].tolist()
+		names = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+		columns = dict((key, arrays[key]) for key in ExonRecords.COLUMNS)
+	return ExonRecords(names, columns)
+	# end read_exon_cache()
+
+def read_name_list(value):
+	# Names from a comma-separated list, or one per line from a file.
+	if os.path.isfile(value):
+		with open(value, 'r') as filein:
+			names = [line.split()[0] for line in filein if len(line.strip())]
+			filein.close()
+		return names
+	return [x.strip() for x in value.split(',') if len(x.strip())]
+	# end read_name_list()
+
+def read_regions(value):
+	# (chromosome, first, last) 1-based inclusive regions, from a BED file or
+	# a comma-separated list of chromosome:first-last.
+	regions = []
+	if os.path.isfile(value):
+		with open(value, 'r') as filein:
+			for line in filein:
+				line = line.strip().split('\t')
+				if len(line) < 3 or line[0].startswith(('#', 'track', 'browser')):
+					continue
+				regions.append((line[0], int(line[1]) + 1, int(line[2])))
+			filein.close()
+	else:
+		for region in value.split(','):
+			chromosome, _, interval = region.strip().rpartition(':')
+			first, last = interval.split('-')
+			regions.append((chromosome, int(first), int(last)))
+	return regions
+	# end read_regions()
+
+class ExonFilter(object):
+	# Include filter on exon BED records: a record is kept when it matches
+	# each of the given gene, transcript and region lists.
+	def __init__(self, genes=None, transcripts=None, regions=None):
+		self.genes = set(genes) if genes is not None else None
+		self.transcripts = set(transcripts) if transcripts is not None else None
+		self.regions = None
+		if regions is not None:
+			self.regions = {}
+			for chromosome, first, last in regions:
+				if chromosome not in self.regions:
+					self.regions[chromosome] = []
+				self.regions[chromosome].append((first, last))
+		# end .__init__()
+
+	def mask(self, records):
+		# Boolean array over ExonRecords, True for the records kept.
+		keep = numpy.ones(len(records), dtype=bool)
+		for column, selected in ((records.gene, self.genes), (records.transcript, self.transcripts)):
+			if selected is not None:
+				codes = [code for code, name in enumerate(records.names) if name in selected]
+				keep &= numpy.isin(column, codes)
+		if self.regions is not None:
+			overlapping = numpy.zeros(len(records), dtype=bool)
+			for code, name in enumerate(records.names):
+				if name in self.regions:
+					on_chromosome = records.chromosome == code
+					for first, last in self.regions[name]:
+						overlapping |= on_chromosome & (records.start <= last) & (records.end >= first)
+			keep &= overlapping
+		return keep
+		# end .mask()
+
+	# end ExonFilter class definition.
+
 class Exon(object):
+	__slots__ = ('number', 'start', 'end', 'transcript', 'depth', 'average', 'metrics')
+
 	def __init__(self, transcript, number, start, end):
 		self.number = number
 		self.start = start
 		self.end = end
 		self.transcript = transcript
-		self.coverage = {}
+		# Per-base depth from start to end, allocated on first coverage.
+		self.depth = None
+		self.average = None
+		self.metrics = None
 		# print('{0} ({1}) exon {2}: {3} bases'.format(
 		# 	self.transcript.gene,
 		# 	self.transcript.transcript,
@@ -27,22 +260,59 @@ class Exon(object):
 		# 	))
 		# end .__init__()
 
-	def add_coverage(self, position, coverage):
-		self.coverage[position] = coverage
-		# print('{0} added coverage {1} to {2}'.format(self, coverage, position))
-		# end .add_coverage()
+	def depth_array(self):
+		if self.depth is None:
+			self.depth = numpy.zeros(len(self), dtype=numpy.uint32)
+		return self.depth
+		# end .depth_array()
 
-	def average_coverage(self):
-		values = []
-		for position in range(self.start, self.end + 1):
-			if position not in self.coverage:
-				values.append(0)
-			else:
-				values.append(self.coverage[position])
+	def add_coverage_runs(self, firsts, lasts, coverages):
+		# Sets every position from firsts[i] to lasts[i] (inclusive) within
+		# the exon to coverages[i].
+		firsts = numpy.maximum(firsts, self.start) - self.start
+		lasts = numpy.minimum(lasts, self.end) - self.start
+		lengths = numpy.maximum(lasts - firsts + 1, 0)
+		offsets = numpy.repeat(firsts - (numpy.cumsum(lengths) - lengths), lengths)
+		self.depth_array()[offsets + numpy.arange(int(lengths.sum()))] = numpy.repeat(coverages, lengths)
+		# end .add_coverage_runs()
 
-		return int(numpy.mean(values))
+	def average_coverage(self):
+		if self.average is not None:
+			return self.average
+		if self.depth is None:
+			return 0
+		return int(self.depth.mean())
 		# end .average_coverage()
 
+	def coverage_metrics(self):
+		# (minimum depth, bases below each EXON_METRIC_THRESHOLDS depth,
+		# coefficient of variation), from one threshold count of the depths:
+		# the cumulative sum of the depth histogram, clipped at the highest
+		# threshold, gives both the minimum and every below-threshold count.
+		if self.metrics is not None:
+			return self.metrics
+		if self.depth is None:
+			return (0,) + (len(self),) * len(EXON_METRIC_THRESHOLDS) + (0.0,)
+		limit = EXON_METRIC_THRESHOLDS[-1]
+		below = numpy.cumsum(numpy.bincount(numpy.minimum(self.depth, limit), minlength=limit + 1))
+		if below[limit - 1]:
+			minimum = int(numpy.searchsorted(below, 0, side='right'))
+		else:
+			minimum = int(self.depth.min())
+		mean = self.depth.mean()
+		cv = 0.0
+		if mean > 0:
+			cv = float(self.depth.std() / mean)
+		return (minimum,) + tuple(int(below[t - 1]) for t in EXON_METRIC_THRESHOLDS) + (cv,)
+		# end .coverage_metrics()
+
+	def finalize(self):
+		# Keeps only the average and metrics and releases the per-base depth.
+		self.average = self.average_coverage()
+		self.metrics = self.coverage_metrics()
+		self.depth = None
+		# end .finalize()
+
 	def __contains__(self, value):
 		return (self.start <= value <= self.end)
 		# end .__contains__()
@@ -65,31 +335,41 @@ class Exon(object):
 
 
 class Transcript(object):
-	def __init__(self, transcript, gene, chromosome = ''):
+	__slots__ = ('chromosome', 'start', 'end', 'transcript', 'gene', 'exons',
+		'strand', 'row', 'length', 'offsets')
+
+	def __init__(self, transcript, gene, chromosome = '', strand = '.'):
 		self.chromosome = chromosome
 		self.start = -1
 		self.end = -1
 		self.transcript = transcript
 		self.gene = gene
 		self.exons = {}
+		self.strand = strand
+		# Row of the transcript in Genome.profiles, total exon length and
+		# offset of each exon along the spliced 5'->3' sequence, set by
+		# .layout().
+		self.row = None
+		self.length = 0
+		self.offsets = {}
 		# end .__init__()
 
-	def add_exon(self, number, start, end):
-		self.exons[number] = Exon(self, number, start, end)
-		if self.start == -1 or start < self.start:
-			self.start = start
-		if self.end == -1 or end > self.end:
-			self.end = end
-		# end .add_exon()
-
-	def add_coverage(self, position, coverage):
-		matched = False
-		for exon in self.exons.values():
-			if position in exon:
-				exon.add_coverage(position, coverage)
-				matched = True
-				break
-		# end .add_coverage()
+	def layout(self, row):
+		# Exons are laid out in exon-number order, which runs 5'->3'. Without
+		# a BED strand, the strand follows from whether exon numbers run down
+		# the genome.
+		self.row = row
+		numbers = sorted(self.exons.keys())
+		if self.strand not in ('+', '-'):
+			self.strand = '+'
+			if len(numbers) > 1 and self.exons[numbers[0]].start > self.exons[numbers[-1]].start:
+				self.strand = '-'
+		self.length = 0
+		self.offsets = {}
+		for number in numbers:
+			self.offsets[number] = self.length
+			self.length += len(self.exons[number])
+		# end .layout()
 
 	def coverage(self):
 		output = []
@@ -126,111 +406,566 @@ class Transcript(object):
 
 	# end Transcript class definition.
 
+class ExonIndex(object):
+	# Unique exon intervals of one chromosome sorted by start, for
+	# binary-search lookups of the coverage runs overlapping them (see
+	# run_ranges()). Exons listed under several transcripts with the same
+	# coordinates share one entry: coverage is loaded into the first of
+	# them and share() fans it out to the duplicates.
+	def __init__(self, exons):
+		starts = numpy.fromiter((exon.start for exon in exons), dtype=numpy.int64, count=len(exons))
+		ends = numpy.fromiter((exon.end for exon in exons), dtype=numpy.int64, count=len(exons))
+		# A stable sort keeps each interval's exons in their listed order, so
+		# the first of them holds the coverage.
+		order = numpy.lexsort((ends, starts))
+		heads = numpy.flatnonzero(numpy.diff(starts[order], prepend=-1) | numpy.diff(ends[order], prepend=-1))
+		self.starts = starts[order[heads]]
+		self.ends = ends[order[heads]]
+		order = order.tolist()
+		self.exons = [exons[order[i]] for i in heads.tolist()]
+		self.duplicates = [()] * len(heads)
+		counts = numpy.diff(numpy.append(heads, len(order)))
+		for i in numpy.flatnonzero(counts > 1).tolist():
+			head = int(heads[i])
+			self.duplicates[i] = [exons[j] for j in order[head + 1:head + counts[i]]]
+		# end .__init__()
+
+	def share(self, indices=None):
+		# Hands the depth and average of each listed (default: every) unique
+		# exon to the exons that duplicate it.
+		if indices is None:
+			indices = range(len(self.exons))
+		for i in indices:
+			exon = self.exons[i]
+			for duplicate in self.duplicates[i]:
+				duplicate.depth = exon.depth
+				duplicate.average = exon.average
+				duplicate.metrics = exon.metrics
+		# end .share()
+
+
+	def spans(self, gap=COVERAGE_SPAN_GAP):
+		# Merges the exon intervals into [first, last] position spans, joining
+		# neighbours less than gap positions apart.
+		spans = []
+		for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+			if len(spans) and start <= spans[-1][1] + gap:
+				spans[-1][1] = max(spans[-1][1], end)
+			else:
+				spans.append([start, end])
+		return spans
+		# end .spans()
+
+	def run_ranges(self, firsts, lasts):
+		# For sorted, non-overlapping runs covering firsts[j]..lasts[j], returns
+		# (lo, hi) arrays such that runs lo[i]:hi[i] overlap exon i.
+		lo = numpy.searchsorted(lasts, self.starts, side='left')
+		hi = numpy.searchsorted(firsts, self.ends, side='right')
+		return lo, hi
+		# end .run_ranges()
+
+	# end ExonIndex class definition.
+
 class Genome(object):
-	def __init__(self):
+	def __init__(self, profiles=False):
+		# With profiles, finalizing exons also sums their depth into the
+		# 5'->3' transcript profiles written by transcript_coverage().
 		self.genome = {}
 		self.genes = {}
 		self.max_exon = 0
+		self.index = {}
+		self.exon_filter = None
+		self.profiling = profiles
+		self.profiles = None
 		# end .__init__()
 
+	def __getstate__(self):
+		# Worker processes only load exon depth and hand it back, so the
+		# profiles are left out of the copy each one receives.
+		state = self.__dict__.copy()
+		state['profiles'] = None
+		return state
+		# end .__getstate__()
 
-	def coverage(self, filepath=None):
-		output = {}
-		header = ['Gene', 'Transcript']
-		for e in range(self.max_exon):
-			header.append('Exon_{0}'.format(e+1))
-		output['-'] = header
+	def build_index(self):
+		self.index = {}
+		rows = 0
+		with gc_paused():
+			for chromosome in self.genome:
+				exons = []
+				for gene in self.genome[chromosome].values():
+					for transcript in gene.values():
+						exons.extend(transcript.exons.values())
+						if self.profiling:
+							transcript.layout(rows)
+							rows += 1
+				self.index[chromosome] = ExonIndex(exons)
+		if self.profiling:
+			# Per-transcript depth sums over PROFILE_BINS equal slices of the
+			# spliced transcript, filled in as exons are finalized.
+			self.profiles = numpy.zeros((rows, PROFILE_BINS), dtype=numpy.float64)
+		return self.index
+		# end .build_index()
+
+	def share_coverage(self):
+		for index in self.index.values():
+			index.share()
+		# end .share_coverage()
+
+
+	def sorted_transcripts(self):
+		# Transcripts ordered by '<gene>_<transcript>', the row order of every
+		# table written.
+		transcripts = {}
 		for chromosome in sorted(self.genome.keys()):
 			for gene in sorted(self.genome[chromosome].keys()):
 				for transcript_id in sorted(self.genome[chromosome][gene].keys()):
 					transcript = self.genome[chromosome][gene][transcript_id]
 					key = '{0}_{1}'.format(transcript.gene, transcript.transcript)
-					output[key] = [transcript.gene, transcript.transcript] + transcript.coverage()
+					transcripts[key] = transcript
+		return [transcripts[key] for key in sorted(transcripts.keys())]
+		# end .sorted_transcripts()
 
+	def coverage(self, filepath=None, metrics_filepath=None, transcripts_filepath=None):
+		# Rows are ordered by '<gene>_<transcript>' (header first). Only those
+		# keys are sorted up front; each row is formatted and written as it
+		# is reached, so the table is never held in memory.
+		header = ['Gene', 'Transcript']
+		for e in range(self.max_exon):
+			header.append('Exon_{0}'.format(e+1))
 
-		if filepath is None:
-			for key in sorted(output.keys()):
-				data = output[key]
-				print('\t'.join([str(x) for x in data]))
-		else:
-			with open(filepath, 'w') as fileout:
-				for key in sorted(output.keys()):
-					data = output[key]
-					fileout.write('{0}\n'.format('\t'.join([str(x) for x in data])))
+		fileout = sys.stdout if filepath is None else open_output(filepath)
+		try:
+			fileout.write('{0}\n'.format('\t'.join(header)))
+			for transcript in self.sorted_transcripts():
+				data = [transcript.gene, transcript.transcript] + transcript.coverage()
+				fileout.write('{0}\n'.format('\t'.join([str(x) for x in data])))
+		finally:
+			if filepath is not None:
 				fileout.close()
 
+		if metrics_filepath is not None:
+			self.coverage_metrics(metrics_filepath)
+		if transcripts_filepath is not None:
+			self.transcript_coverage(transcripts_filepath)
+
 		# end .coverage()		
 
-	def find_transcripts(self, chromosome, position):
-		matches = []
-		if chromosome in self.genome:
-			for gene in sorted(self.genome[chromosome].keys()):
-				for transcript in sorted(self.genome[chromosome][gene].keys()):
-					if position in self.genome[chromosome][gene][transcript]:
-						matches.append(self.genome[chromosome][gene][transcript])
-		return matches
-		# end .find_transcripts()
-
-	def load_exons(self, filepath):
-		with open(filepath, 'Ur') as filein:
-			for line in filein:
-				line = line.strip()
-				if len(line):
-					line = line.split('\t')
-					gene_symbol, _, exon, transcript_id = [str(x).strip() for x in line[3].strip().split(' ')]
-					chromosome = line[0].strip()
-
-					if chromosome not in self.genome:
-						self.genome[chromosome] = {}
-
-					if gene_symbol not in self.genes:
-						self.genes[gene_symbol] = {}
-						self.genome[chromosome][gene_symbol] = self.genes[gene_symbol]
-						
-					if transcript_id not in self.genes[gene_symbol]:
-						transcript = Transcript(chromosome=line[0], transcript=transcript_id, gene=gene_symbol)
-						self.genes[gene_symbol][transcript_id] = transcript
-					else:
-						transcript = self.genes[gene_symbol][transcript_id]
-					
-					exon = int(exon)
-					transcript.add_exon(exon, int(line[1]), int(line[2]))
-					if exon > self.max_exon:
-						self.max_exon = exon
-				# end if len(line) block
-			# end for loop
-			filein.close()
+	def exon_averages(self):
+		# (gene, transcript, exon number, average) rows in coverage() order.
+		rows = []
+		for transcript in self.sorted_transcripts():
+			for number in sorted(transcript.exons.keys()):
+				exon = transcript.exons[number]
+				rows.append((transcript.gene, transcript.transcript, number, exon.average_coverage()))
+		return rows
+		# end .exon_averages()
+
+	def coverage_metrics(self, filepath):
+		# Writes one row of extended metrics per exon, in coverage() order.
+		header = ['Gene', 'Transcript', 'Exon', 'Mean_Depth', 'Min_Depth']
+		for threshold in EXON_METRIC_THRESHOLDS:
+			header.append('Bases_Below_{0}x'.format(threshold))
+		header.append('CV')
+		with open_output(filepath) as fileout:
+			fileout.write('{0}\n'.format('\t'.join(header)))
+			for transcript in self.sorted_transcripts():
+				for number in sorted(transcript.exons.keys()):
+					exon = transcript.exons[number]
+					metrics = exon.coverage_metrics()
+					data = [transcript.gene, transcript.transcript, number, exon.average_coverage()]
+					data.extend(metrics[:-1])
+					data.append('{0:.4f}'.format(metrics[-1]))
+					fileout.write('{0}\n'.format('\t'.join([str(x) for x in data])))
+			fileout.close()
+		return True
+		# end .coverage_metrics()
+
+	def reset_coverage(self):
+		for index in self.index.values():
+			for exon in index.exons:
+				exon.depth = None
+				exon.average = None
+				exon.metrics = None
+			index.share()
+		if self.profiles is not None:
+			self.profiles[:] = 0
+		# end .reset_coverage()
+
+
+	def load_exons(self, filepath, cache_dir=None, exon_filter=None):
+		# With a cache_dir the parsed exon records are kept as arrays in
+		# <cache_dir>/<sha1 of the BED>.exons.npz, so later runs on the same
+		# BED skip the text parsing. The cache always holds the whole BED;
+		# exon_filter (an ExonFilter) selects the records that make up the
+		# model.
+		records = None
+		cache_filepath = None
+		if cache_dir is not None:
+			cache_filepath = os.path.join(cache_dir, '{0}{1}'.format(exon_file_digest(filepath), EXON_CACHE_SUFFIX))
+			if os.path.isfile(cache_filepath):
+				try:
+					records = read_exon_cache(cache_filepath)
+				except (IOError, OSError, ValueError, KeyError):
+					records = None
+
+		if records is None:
+			records = parse_exon_bed(filepath)
+			if cache_filepath is not None:
+				try:
+					write_exon_cache(cache_filepath, records)
+				except (IOError, OSError):
+					# An unwritable cache directory only costs a re-parse next time.
+					pass
+
+		self.exon_filter = exon_filter
+		self.add_exon_records(records, None if exon_filter is None else exon_filter.mask(records))
+		self.build_index()
 		return True
 		# end .load_exons()
 
-	def load_coverage(self, filepath):
-		with open(filepath, 'Ur') as filein:
-			counter = 0
-			for line in filein:
-				line = line.strip()
-				if len(line):
-					line = line.split('\t')
-					chromosome = line[0]
-					position = int(line[1])
-					coverage = int(line[2])
-
-					transcripts = self.find_transcripts(chromosome, position)
-					for transcript in transcripts:
-						transcript.add_coverage(position, coverage)
-				# end if len(line) block
+	def add_exon_records(self, records, keep=None):
+		# Adds the ExonRecords (only those where keep is True) as if one at a
+		# time in BED order: a gene is listed under the chromosome of its first
+		# record, a transcript takes the chromosome and strand of its first
+		# record, and a repeated exon number replaces the earlier exon.
+		columns = [getattr(records, key) for key in ExonRecords.COLUMNS]
+		if keep is not None:
+			columns = [column[keep] for column in columns]
+		chromosomes, genes, transcripts, strands, numbers, starts, ends = columns
+		if not len(numbers):
+			return
+		names = records.names
+
+		# Transcripts numbered in order of their first record.
+		keys = genes.astype(numpy.int64) * len(names) + transcripts
+		_, firsts, rows = numpy.unique(keys, return_index=True, return_inverse=True)
+		order = numpy.argsort(firsts, kind='stable')
+		ranks = numpy.empty_like(order)
+		ranks[order] = numpy.arange(len(order))
+		firsts = firsts[order]
+		rows = ranks[rows.ravel()]
+		lows = numpy.full(len(firsts), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+		highs = numpy.full(len(firsts), numpy.iinfo(numpy.int64).min, dtype=numpy.int64)
+		numpy.minimum.at(lows, rows, starts)
+		numpy.maximum.at(highs, rows, ends)
+
+		_, chromosome_firsts = numpy.unique(chromosomes, return_index=True)
+		_, gene_firsts = numpy.unique(genes, return_index=True)
+		chromosomes, genes, transcripts, strands = [column.tolist() for column in columns[:4]]
+		with gc_paused():
+			for i in numpy.sort(chromosome_firsts).tolist():
+				if names[chromosomes[i]] not in self.genome:
+					self.genome[names[chromosomes[i]]] = {}
+			for i in numpy.sort(gene_firsts).tolist():
+				gene_symbol = names[genes[i]]
+				if gene_symbol not in self.genes:
+					self.genes[gene_symbol] = {}
+					self.genome[names[chromosomes[i]]][gene_symbol] = self.genes[gene_symbol]
+
+			models = []
+			for i, low, high in zip(firsts.tolist(), lows.tolist(), highs.tolist()):
+				gene_symbol = names[genes[i]]
+				transcript_id = names[transcripts[i]]
+				gene = self.genes[gene_symbol]
+				if transcript_id not in gene:
+					gene[transcript_id] = Transcript(chromosome=names[chromosomes[i]],
+						transcript=transcript_id, gene=gene_symbol, strand=names[strands[i]])
+				transcript = gene[transcript_id]
+				if transcript.start == -1 or low < transcript.start:
+					transcript.start = low
+				if transcript.end == -1 or high > transcript.end:
+					transcript.end = high
+				models.append(transcript)
+
+			for row, number, start, end in zip(rows.tolist(), numbers.tolist(), starts.tolist(), ends.tolist()):
+				transcript = models[row]
+				transcript.exons[number] = Exon(transcript, number, start, end)
+		self.max_exon = max(self.max_exon, int(numbers.max()))
+		# end .add_exon_records()
+
+	def load_coverage(self, filepath, format='dz', byte_range=None, streaming=False):
+		# Each coverage run [start, end) covers 1-based positions start+1..end,
+		# so per-base ('dz') and run-length ('bga') input load identically.
+		# With streaming, genomecov's coordinate order is used to finalize each
+		# exon as soon as the coverage has moved past its end, so only the
+		# exons currently open hold per-base coverage.
+		pending = {}
+		if streaming:
+			for chromosome, index in self.index.items():
+				pending[chromosome] = numpy.ones(len(index.exons), dtype=bool)
+		previous = None
+
+		reader = GenomecovReader(filepath, format=format, byte_range=byte_range)
+		for chromosome_ids, starts, ends, depths in reader.runs():
+			for code, lo, hi in split_by_chromosome(chromosome_ids):
+				chromosome = reader.chromosomes[code]
+				if previous in pending and previous != chromosome:
+					self._finalize_exons(previous, pending, pending[previous])
+				previous = chromosome
+				if chromosome not in self.index:
+					continue
+				firsts = starts[lo:hi] + 1
+				lasts = ends[lo:hi]
+				coverages = depths[lo:hi]
+				if (firsts[1:] <= lasts[:-1]).any():
+					order = numpy.argsort(firsts, kind='mergesort')
+					firsts, lasts, coverages = firsts[order], lasts[order], coverages[order]
+				index = self.index[chromosome]
+				run_lo, run_hi = index.run_ranges(firsts, lasts)
+				for i in numpy.flatnonzero(run_hi > run_lo).tolist():
+					a, b = run_lo[i], run_hi[i]
+					index.exons[i].add_coverage_runs(firsts[a:b], lasts[a:b], coverages[a:b])
+				if streaming:
+					self._finalize_exons(chromosome, pending, index.ends <= lasts[-1])
 			# end for loop
-			filein.close()
+
+		for chromosome in pending:
+			self._finalize_exons(chromosome, pending, pending[chromosome])
+		self.share_coverage()
 		return True
 		# end .load_coverage()
+
+	def _finalize_exons(self, chromosome, pending, mask):
+		# Finalizes the chromosome's still pending indexed exons selected by
+		# mask, and clears them from pending.
+		done = pending[chromosome] & mask
+		self.finalize_exons(chromosome, numpy.flatnonzero(done).tolist())
+		pending[chromosome] &= ~done
+		# end ._finalize_exons()
+
+	def load_coverage_indexed(self, filepath, format='dz'):
+		# Reads only the parts of the genomecov file around the indexed exons:
+		# the chromosome byte-offset index (<genomecov>.chromidx) locates each
+		# chromosome, and a bisection on position within it each exon span.
+		if format == 'auto':
+			format = detect_format(filepath)
+		# Fields holding the first and last 1-based position of a line's run:
+		# the position itself for 'dz', start + 1 and end for 'bga'.
+		last_column = 1 if format == 'dz' else 2
+		first_offset = 0 if format == 'dz' else 1
+		with open(filepath, 'rb') as filein:
+			for chromosome, start, end in load_chromosome_index(filepath):
+				if chromosome not in self.index:
+					continue
+				for first, last in self.index[chromosome].spans():
+					lo = find_line_offset(filein, start, end, last_column, first)
+					hi = find_line_offset(filein, lo, end, 1, last + 1 - first_offset)
+					if lo < hi:
+						self.load_coverage(filepath, format, byte_range=(lo, hi))
+			filein.close()
+		self.share_coverage()
+		return True
+		# end .load_coverage_indexed()
+
+	def finalize_exons(self, chromosome, indices):
+		# Adds the listed unique exons' depth to the profiles (if kept) of every
+		# transcript holding them, then keeps only their averages and metrics.
+		index = self.index[chromosome]
+		for i in indices:
+			exon = index.exons[i]
+			if exon.depth is not None and self.profiles is not None:
+				self._profile_exon(exon, exon.depth)
+				for duplicate in index.duplicates[i]:
+					self._profile_exon(duplicate, exon.depth)
+			exon.finalize()
+		index.share(indices)
+		# end .finalize_exons()
+
+	def finalize_coverage(self):
+		# Finalizes every exon not yet finalized while loading.
+		for chromosome, index in self.index.items():
+			self.finalize_exons(chromosome, [i for i, exon in enumerate(index.exons) if exon.average is None])
+		# end .finalize_coverage()
+
+	def _profile_exon(self, exon, depth):
+		transcript = exon.transcript
+		# Offset of each base along the transcript, 5'->3'.
+		if transcript.strand == '-':
+			offsets = numpy.arange(transcript.offsets[exon.number] + len(depth) - 1, transcript.offsets[exon.number] - 1, -1)
+		else:
+			offsets = numpy.arange(transcript.offsets[exon.number], transcript.offsets[exon.number] + len(depth))
+		bins = offsets * PROFILE_BINS // transcript.length
+		self.profiles[transcript.row] += numpy.bincount(bins, weights=depth, minlength=PROFILE_BINS)
+		# end ._profile_exon()
+
+	def transcript_coverage(self, filepath):
+		# Writes each transcript's mean depth over its exons and its coverage
+		# profile: the mean depth of each of PROFILE_BINS equal 5'->3' slices
+		# of the spliced transcript, relative to the transcript mean.
+		if self.profiles is None:
+			raise ValueError('Transcript coverage needs a Genome built with profiles=True')
+		self.finalize_coverage()
+		header = ['Gene', 'Transcript', 'Strand', 'Length', 'Mean_Depth']
+		for b in range(PROFILE_BINS):
+			header.append('Bin_{0}'.format(b + 1))
+		with open_output(filepath) as fileout:
+			fileout.write('{0}\n'.format('\t'.join(header)))
+			for transcript in self.sorted_transcripts():
+				sums = self.profiles[transcript.row]
+				bases = numpy.bincount(numpy.arange(transcript.length) * PROFILE_BINS // transcript.length, minlength=PROFILE_BINS)
+				mean = sums.sum() / transcript.length
+				data = [transcript.gene, transcript.transcript, transcript.strand, transcript.length, '{0:.2f}'.format(mean)]
+				for total, count in zip(sums.tolist(), bases.tolist()):
+					if not count:
+						data.append('NA')
+					elif mean > 0:
+						data.append('{0:.4f}'.format(total / count / mean))
+					else:
+						data.append('0.0000')
+				fileout.write('{0}\n'.format('\t'.join([str(x) for x in data])))
+			fileout.close()
+		return True
+		# end .transcript_coverage()
+
+	def load_depth_store(self, filepath):
+		# Slices each exon's positions straight out of a binary depth store.
+		store = DepthStore(filepath)
+		for chromosome, index in self.index.items():
+			if chromosome not in store:
+				continue
+			depth = store.depth(chromosome)
+			for exon in index.exons:
+				# Store element i holds 1-based position i + 1.
+				first = max(exon.start, 1)
+				values = depth[first - 1:exon.end]
+				if len(values):
+					exon.depth_array()[first - exon.start:first - exon.start + len(values)] = values
+		self.share_coverage()
+		return True
+		# end .load_depth_store()
+
+	def take_exon_coverage(self, chromosome):
+		# Hands over (and resets) the depth of one chromosome's unique exons,
+		# keyed by their position in the chromosome's index.
+		coverage = {}
+		if chromosome in self.index:
+			for i, exon in enumerate(self.index[chromosome].exons):
+				if exon.depth is not None:
+					coverage[i] = exon.depth
+					exon.depth = None
+			self.index[chromosome].share()
+		return chromosome, coverage
+		# end .take_exon_coverage()
+
+	def load_coverage_sharded(self, filepath, format='dz', processes=None):
+		# Loads each chromosome of the genomecov file in a separate worker
+		# process, using the byte-offset index kept next to the file, and
+		# merges the per-exon coverage the workers return.
+		if format == 'auto':
+			format = detect_format(filepath)
+		jobs = []
+		for chromosome, start, end in load_chromosome_index(filepath):
+			if chromosome in self.genome:
+				jobs.append((filepath, format, chromosome, (start, end)))
+
+		pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self,))
+		try:
+			for chromosome, coverage in pool.imap_unordered(_shard_worker, jobs):
+				for i, depth in coverage.items():
+					self.index[chromosome].exons[i].depth = depth
+		finally:
+			pool.close()
+			pool.join()
+		self.share_coverage()
+		return True
+		# end .load_coverage_sharded()
 	# end Genome class definition.
 
 
+# Genome model shared with the shard worker processes.
+_worker_state = {}
+
+def _init_worker(genome):
+	_worker_state['genome'] = genome
+	# end _init_worker()
+
+def _shard_worker(job):
+	filepath, format, chromosome, byte_range = job
+	genome = _worker_state['genome']
+	genome.load_coverage(filepath, format, byte_range)
+	return genome.take_exon_coverage(chromosome)
+	# end _shard_worker()
+
+def _cohort_worker(sample):
+	name, filepath, format = sample
+	genome = _worker_state['genome']
+	genome.reset_coverage()
+	if is_depth_store(filepath):
+		genome.load_depth_store(filepath)
+	elif genome.exon_filter is not None:
+		genome.load_coverage_indexed(filepath, format)
+	else:
+		genome.load_coverage(filepath, format, streaming=True)
+	return name, genome.exon_averages()
+	# end _cohort_worker()
+
+"""
+Computes the per-exon averages of many (name, filepath) samples against
+one loaded genome, spread over a pool of worker processes that each get
+a copy of the exon model once. Writes a long-format table with one
+(sample, gene, transcript, exon, mean depth) row per exon.
+"""
+def cohort_coverage(genome, samples, filepath, format='auto', processes=None):
+	jobs = [(name, sample_filepath, format) for name, sample_filepath in samples]
+	if processes == 1:
+		_init_worker(genome)
+		results = map(_cohort_worker, jobs)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(genome,))
+		results = pool.imap(_cohort_worker, jobs)
+
+	try:
+		with open_output(filepath) as fileout:
+			fileout.write('Sample\tGene\tTranscript\tExon\tMean_Depth\n')
+			for name, rows in results:
+				for row in rows:
+					fileout.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(name, *row))
+			fileout.close()
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	return True
+	# end cohort_coverage()
+
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Exon Coverage')
 
 	parser.add_argument('-b', '--bedfile', dest='bedfile', help='In-target exons BED file.')
 	parser.add_argument('-g', '--genomecov', dest='genomecov', help='Genomecov output file.')
+	parser.add_argument('--exon-metrics', dest='exon_metrics',
+		help='Also write per-exon minimum depth, bases below {0}x and coefficient '
+		'of variation to this file.'.format('/'.join([str(x) for x in EXON_METRIC_THRESHOLDS])))
+	parser.add_argument('--transcript-coverage', dest='transcript_coverage',
+		help='Also write each transcript\'s mean depth and {0}-bin 5\'->3\' coverage '
+		'profile to this file.'.format(PROFILE_BINS))
+	parser.add_argument('--cache-dir', dest='cache_dir',
+		help='Directory for the binary cache of the parsed exon BED.')
+	parser.add_argument('-m', '--manifest', dest='manifest',
+		help='Cohort mode: file listing one genomecov filepath per line, optionally '
+		'preceded by a sample name and a tab.')
 	parser.add_argument('-o', '--output', dest='output', help='Output filepath.')
+	parser.add_argument('--genes', dest='genes',
+		help='Only load exons of these genes (comma-separated, or a file with one per line).')
+	parser.add_argument('--transcripts', dest='transcripts',
+		help='Only load exons of these transcripts (comma-separated, or a file with one per line).')
+	parser.add_argument('--regions', dest='regions',
+		help='Only load exons overlapping these regions (a BED file, or comma-separated '
+		'chromosome:first-last). With any filter only the matching parts of the genomecov '
+		'file are read, using its byte-offset index.')
+	parser.add_argument('--format', dest='format', default='auto', choices=['auto', 'dz', 'bga'],
+		help='Genomecov format: per-base -dz or run-length -bga/bedGraph (default: detected).')
+	parser.add_argument('--streaming', dest='streaming', action='store_true',
+		help='Finalize each exon as soon as the coordinate-sorted coverage has passed it, '
+		'keeping per-base coverage only for the exons currently open.')
+	parser.add_argument('--shard', dest='shard', action='store_true',
+		help='Load each chromosome in parallel, using a byte-offset index of the '
+		'genomecov file kept next to it (built on first use).')
+	parser.add_argument('-p', '--processes', dest='processes', type=int, default=None,
+		help='Worker processes for --shard or cohort mode (default: one per CPU).')
 	args = parser.parse_args()
 
 
@@ -244,7 +979,28 @@ if __name__ == '__main__':
 			exit(1)
 
 
-	if args.genomecov is None:
+	if args.manifest is not None:
+		manifest_filepath = os.path.abspath(args.manifest)
+		if not os.path.isfile(manifest_filepath):
+			print('Error: File {0} does not exist.'.format(manifest_filepath))
+			exit(1)
+		samples = read_manifest(manifest_filepath)
+		for name, sample_filepath in samples:
+			if not os.path.isfile(sample_filepath):
+				print('Error: File {0} does not exist.'.format(sample_filepath))
+				exit(1)
+		# Cohort mode writes only the long-format table of exon averages and
+		# always streams each sample through one worker.
+		unsupported = [option for option, value in (
+			('--exon-metrics', args.exon_metrics is not None),
+			('--transcript-coverage', args.transcript_coverage is not None),
+			('--streaming', args.streaming),
+			('--shard', args.shard),
+			) if value]
+		if len(unsupported):
+			print('Error: {0} cannot be combined with -m.'.format(', '.join(unsupported)))
+			exit(1)
+	elif args.genomecov is None:
 		print('Error: Genomecov file filepath not specified.')
 		exit(1)
 	else:
@@ -262,9 +1018,36 @@ if __name__ == '__main__':
 			print('Warning: Output file {0} '.format(output_filepath) + 
 			 'already exists and will be overwritten.')
 
+	if args.cache_dir is not None and not os.path.isdir(args.cache_dir):
+		os.makedirs(args.cache_dir)
+
+
+	exon_filter = None
+	if args.genes is not None or args.transcripts is not None or args.regions is not None:
+		exon_filter = ExonFilter(
+			genes=read_name_list(args.genes) if args.genes is not None else None,
+			transcripts=read_name_list(args.transcripts) if args.transcripts is not None else None,
+			regions=read_regions(args.regions) if args.regions is not None else None)
 
-	genome = Genome()
-	genome.load_exons(bedfile_filepath)
+	genome = Genome(profiles=args.transcript_coverage is not None)
+	genome.load_exons(bedfile_filepath, args.cache_dir, exon_filter)
 
-	genome.load_coverage(coverage_filepath)
-	genome.coverage(output_filepath)
+	if args.manifest is not None:
+		cohort_coverage(genome, samples, output_filepath, args.format, args.processes)
+		exit()
+
+	if is_depth_store(coverage_filepath):
+		genome.load_depth_store(coverage_filepath)
+	elif args.shard:
+		genome.load_coverage_sharded(coverage_filepath, args.format, args.processes)
+	elif exon_filter is not None:
+		genome.load_coverage_indexed(coverage_filepath, args.format)
+	else:
+		genome.load_coverage(coverage_filepath, args.format, streaming=args.streaming)
+	exon_metrics_filepath = None
+	if args.exon_metrics is not None:
+		exon_metrics_filepath = os.path.abspath(args.exon_metrics)
+	transcripts_filepath = None
+	if args.transcript_coverage is not None:
+		transcripts_filepath = os.path.abspath(args.transcript_coverage)
+	genome.coverage(output_filepath, exon_metrics_filepath, transcripts_filepath)
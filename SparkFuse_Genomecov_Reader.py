@@ -0,0 +1,363 @@
+# @file genomecov_reader.py
+#
+# Shared reader for the coverage output of BEDtools genomecov, either one
+# line per covered base ('dz') or run-length bedGraph ('bga'), e.g.
+#     bedtools genomecov -split -dz -ibam input_file.bam -g genome.fasta > genomecov.txt
+#     bedtools genomecov -split -bga -ibam input_file.bam -g genome.fasta > genomecov.bedgraph
+#
+# The file is read in large byte chunks and each chunk is parsed into numpy
+# arrays in one go, so parsing runs at array speed rather than one Python
+# string split per line. Chromosome names are interned to integer codes.
+#
+# A byte-offset index of where each chromosome starts and ends in a
+# genomecov file can be built once and kept next to it (<file>.chromidx),
+# so that single chromosomes can be read, e.g. by parallel workers. Within a
+# chromosome's byte range, find_line_offset() bisects on position so that
+# only the lines around a region need to be read.
+
+import os
+import numpy
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+INDEX_SUFFIX = '.chromidx'
+
+# Number of tab-delimited columns of each supported genomecov format.
+FORMAT_COLUMNS = {
+    'dz': 3,
+    'bga': 4,
+    }
+
+_NEWLINE = ord('\n')
+_TAB = ord('\t')
+_SPACE = ord(' ')
+_ZERO = ord('0')
+_NINE = ord('9')
+
+"""
+Interns chromosome names to small integer codes, in order of first
+appearance. Codes index back into .names.
+"""
+class ChromosomeTable(object):
+    def __init__(self):
+        self.names = []
+        self.codes = {}
+        # end .__init__()
+
+    def intern(self, name):
+        if name not in self.codes:
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+        return self.codes[name]
+        # end .intern()
+
+    def __getitem__(self, code):
+        return self.names[code]
+        # end .__getitem__()
+
+    def __len__(self):
+        return len(self.names)
+        # end .__len__()
+
+    # end ChromosomeTable class definition.
+
+"""
+Returns a boolean array flagging every line whose name field,
+chunk[starts[i]:ends[i]], differs from the line before it. Genomecov
+output is grouped by chromosome, so only the first and last names of a
+range of lines are compared, and ranges whose ends differ are bisected
+down to the change points. A chunk from one chromosome costs a single
+comparison.
+"""
+def _name_changes(chunk, starts, ends):
+    changed = numpy.zeros(len(starts), dtype=bool)
+    if not len(starts):
+        return changed
+    changed[0] = True
+    ranges = [(0, len(starts) - 1)]
+    while len(ranges):
+        low, high = ranges.pop()
+        if high <= low or (chunk[int(starts[low]):int(ends[low])] ==
+                chunk[int(starts[high]):int(ends[high])]):
+            continue
+        if high == low + 1:
+            changed[high] = True
+            continue
+        middle = (low + high) // 2
+        ranges.append((low, middle))
+        ranges.append((middle, high))
+    return changed
+    # end _name_changes()
+
+"""
+Splits a batch's chromosome id array into runs of equal ids. Yields
+(chromosome_id, start, end) so that ids[start:end] share one chromosome.
+"""
+def split_by_chromosome(chromosome_ids):
+    if not len(chromosome_ids):
+        return
+    breaks = numpy.flatnonzero(chromosome_ids[1:] != chromosome_ids[:-1]) + 1
+    bounds = [0] + breaks.tolist() + [len(chromosome_ids)]
+    for i in range(len(bounds) - 1):
+        yield int(chromosome_ids[bounds[i]]), bounds[i], bounds[i + 1]
+    # end split_by_chromosome()
+
+"""
+Guesses the genomecov format of a file from the column count of its
+first non-blank line. Returns 'dz' or 'bga'.
+"""
+def detect_format(filepath):
+    with open(filepath, 'r') as filein:
+        for line in filein:
+            line = line.strip()
+            if len(line):
+                columns = len(line.split('\t'))
+                for format, count in FORMAT_COLUMNS.items():
+                    if count == columns:
+                        return format
+                raise ValueError('Unrecognised genomecov format in {0}.'.format(filepath))
+        filein.close()
+    return 'dz'
+    # end detect_format()
+
+"""
+Iterates over a genomecov file in record batches, one entry per line.
+For 'dz' input each batch is a tuple of numpy int64 arrays
+(chromosome_ids, positions, depths) with positions 1-based as genomecov
+writes them; for 'bga' input it is (chromosome_ids, starts, ends,
+depths) in half-open bedGraph coordinates. .runs() gives the latter
+form for either format. The chromosome ids are codes into .chromosomes,
+which may be shared between readers so that codes agree across files.
+A (start, end) byte_range, e.g. from load_chromosome_index(), limits
+reading to that part of the file.
+"""
+class GenomecovReader(object):
+    def __init__(self, filepath, chunk_size=DEFAULT_CHUNK_SIZE, chromosomes=None,
+            format='dz', byte_range=None):
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.byte_range = byte_range
+        if chromosomes is None:
+            chromosomes = ChromosomeTable()
+        self.chromosomes = chromosomes
+        if format == 'auto':
+            format = detect_format(filepath)
+        if format not in FORMAT_COLUMNS:
+            raise ValueError('Unknown genomecov format {0}.'.format(format))
+        self.format = format
+        self.columns = FORMAT_COLUMNS[format]
+        # end .__init__()
+
+    def runs(self):
+        # A per-base record at 1-based position p is the run [p - 1, p).
+        for batch in self:
+            if self.format == 'dz':
+                chromosome_ids, positions, depths = batch
+                yield chromosome_ids, positions - 1, positions, depths
+            else:
+                yield batch
+        # end .runs()
+
+    def __iter__(self):
+        with open(self.filepath, 'rb') as filein:
+            remaining = None
+            if self.byte_range is not None:
+                filein.seek(self.byte_range[0])
+                remaining = self.byte_range[1] - self.byte_range[0]
+            remainder = b''
+            while True:
+                if remaining is None:
+                    chunk = filein.read(self.chunk_size)
+                else:
+                    chunk = filein.read(min(self.chunk_size, remaining))
+                    remaining -= len(chunk)
+                if not len(chunk):
+                    break
+                chunk = remainder + chunk
+                cut = chunk.rfind(b'\n') + 1
+                remainder = chunk[cut:]
+                if cut:
+                    yield self.parse(chunk[:cut])
+            if len(remainder.strip()):
+                yield self.parse(remainder + b'\n')
+            filein.close()
+        # end .__iter__()
+
+    def parse(self, chunk):
+        if b'\r' in chunk:
+            chunk = chunk.replace(b'\r', b'')
+        buf = numpy.frombuffer(chunk, dtype=numpy.uint8)
+
+        # Locate every line and drop the blank ones.
+        line_ends = numpy.flatnonzero(buf == _NEWLINE)
+        line_starts = numpy.concatenate(([0], line_ends[:-1] + 1))
+        keep = line_ends > line_starts
+        line_starts = line_starts[keep]
+        line_ends = line_ends[keep]
+        if not len(line_ends):
+            # Only blank lines, e.g. a trailing one alone in the last chunk.
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return tuple([empty] * self.columns)
+
+        # Every line must hold exactly columns - 1 tabs, all inside it.
+        tabs = numpy.flatnonzero(buf == _TAB)
+        if len(tabs) != len(line_ends) * (self.columns - 1):
+            raise ValueError('Expected {0} tab-delimited columns in {1}.'.format(
+                self.columns, self.filepath))
+        tabs = tabs.reshape(-1, self.columns - 1)
+        if (tabs[:, 0] <= line_starts).any() or (tabs[:, -1] >= line_ends).any():
+            raise ValueError('Expected {0} tab-delimited columns in {1}.'.format(
+                self.columns, self.filepath))
+        name_ends = tabs[:, 0]
+
+        changed = _name_changes(chunk, line_starts, name_ends)
+        heads = numpy.flatnonzero(changed)
+        codes = numpy.array([
+            self.chromosomes.intern(chunk[line_starts[i]:name_ends[i]].decode())
+            for i in heads.tolist()
+            ], dtype=numpy.int64)
+        chromosome_ids = numpy.repeat(codes, numpy.diff(numpy.append(heads, len(changed))))
+
+        # Blank out the chromosome names and let numpy's C parser read the
+        # remaining whitespace-separated integer columns in one call.
+        marks = numpy.zeros(len(buf) + 1, dtype=numpy.int8)
+        marks[line_starts] = 1
+        marks[name_ends] = -1
+        names = numpy.cumsum(marks[:-1], dtype=numpy.int8).view(bool)
+        numbers = numpy.where(names, numpy.uint8(_SPACE), buf)
+        if (numbers > _NINE).any() or ((numbers < _ZERO) & (numbers > _SPACE)).any():
+            raise ValueError('Non-integer value in {0}.'.format(self.filepath))
+        values = numpy.fromstring(numbers.tobytes(), dtype=numpy.int64, sep=' ')
+        if len(values) != len(line_ends) * (self.columns - 1):
+            raise ValueError('Non-integer value in {0}.'.format(self.filepath))
+        values = values.reshape(-1, self.columns - 1)
+
+        return tuple([chromosome_ids] + [values[:, k] for k in range(self.columns - 1)])
+        # end .parse()
+
+    # end GenomecovReader class definition.
+
+"""
+Records the byte offset at which each new chromosome starts within one
+chunk of whole lines that begins at file offset `offset`, appending
+[name, start] entries to index.
+"""
+def _index_chunk(chunk, offset, index):
+    buf = numpy.frombuffer(chunk, dtype=numpy.uint8)
+    line_ends = numpy.flatnonzero(buf == _NEWLINE)
+    line_starts = numpy.concatenate(([0], line_ends[:-1] + 1))
+    keep = line_ends > line_starts
+    line_starts = line_starts[keep]
+    line_ends = line_ends[keep]
+    if not len(line_starts):
+        return
+
+    tabs = numpy.flatnonzero(buf == _TAB)
+    first_tabs = numpy.searchsorted(tabs, line_starts)
+    if (first_tabs >= len(tabs)).any() or (tabs[numpy.minimum(first_tabs, len(tabs) - 1)] > line_ends).any():
+        raise ValueError('Line without tab-delimited columns in genomecov input.')
+    name_ends = tabs[first_tabs]
+
+    changed = _name_changes(chunk, line_starts, name_ends)
+    names = [x[0] for x in index]
+    for i in numpy.flatnonzero(changed).tolist():
+        name = chunk[line_starts[i]:name_ends[i]].decode()
+        if len(names) and names[-1] == name:
+            continue
+        if name in names:
+            raise ValueError('Genomecov input is not grouped by chromosome ({0}).'.format(name))
+        index.append([name, offset + int(line_starts[i])])
+        names.append(name)
+    # end _index_chunk()
+
+"""
+Scans a genomecov file once and returns a list of (chromosome, start,
+end) byte ranges, one per chromosome, in file order. Every chromosome
+must occupy one contiguous block of lines, as genomecov writes them.
+"""
+def build_chromosome_index(filepath, chunk_size=DEFAULT_CHUNK_SIZE):
+    index = []
+    offset = 0
+    with open(filepath, 'rb') as filein:
+        remainder = b''
+        while True:
+            chunk = filein.read(chunk_size)
+            if not len(chunk):
+                break
+            chunk = remainder + chunk
+            cut = chunk.rfind(b'\n') + 1
+            remainder = chunk[cut:]
+            if cut:
+                _index_chunk(chunk[:cut], offset, index)
+                offset += cut
+        if len(remainder.strip()):
+            _index_chunk(remainder + b'\n', offset, index)
+        filein.close()
+
+    size = os.path.getsize(filepath)
+    ends = [x[1] for x in index[1:]] + [size]
+    return [(name, start, end) for (name, start), end in zip(index, ends)]
+    # end build_chromosome_index()
+
+"""
+Returns the chromosome byte-range index of a genomecov file (see
+build_chromosome_index()). The index is kept next to the file as
+<file>.chromidx and rebuilt when missing or older than the file.
+"""
+def load_chromosome_index(filepath):
+    index_filepath = filepath + INDEX_SUFFIX
+    size = os.path.getsize(filepath)
+    if (os.path.isfile(index_filepath) and
+            os.path.getmtime(index_filepath) >= os.path.getmtime(filepath)):
+        with open(index_filepath, 'r') as filein:
+            lines = [line.rstrip('\n').split('\t') for line in filein if len(line.strip())]
+            filein.close()
+        if len(lines) and lines[0] == ['#size', str(size)]:
+            return [(x[0], int(x[1]), int(x[2])) for x in lines[1:]]
+
+    index = build_chromosome_index(filepath)
+    try:
+        with open(index_filepath, 'w') as fileout:
+            fileout.write('#size\t{0}\n'.format(size))
+            for entry in index:
+                fileout.write('{0}\t{1}\t{2}\n'.format(*entry))
+            fileout.close()
+    except (IOError, OSError):
+        # A read-only location only costs a rescan next time.
+        pass
+    return index
+    # end load_chromosome_index()
+
+"""
+Returns the offset of the first line in the byte range [start, end) of an
+open (binary) genomecov file whose integer field `column` is at least
+value, or end when there is none. The range must start on a line and its
+lines be sorted by that field, as within one chromosome of genomecov
+output. Bisects on byte offsets until the window is small, then scans it.
+"""
+def find_line_offset(filein, start, end, column, value, scan_size=65536):
+    low, high = start, end
+    while high - low > scan_size:
+        middle = (low + high) // 2
+        filein.seek(middle - 1)
+        filein.readline()
+        line_start = filein.tell()
+        fields = filein.readline().split(b'\t')
+        if line_start >= high or len(fields) <= column:
+            break
+        if int(fields[column]) < value:
+            low = filein.tell()
+        else:
+            high = line_start
+
+    filein.seek(low)
+    offset = low
+    while offset < high:
+        line = filein.readline()
+        if not len(line):
+            break
+        fields = line.split(b'\t')
+        if len(fields) > column and int(fields[column]) >= value:
+            return offset
+        offset += len(line)
+    return high
+    # end find_line_offset()
@@ -0,0 +1,28 @@
+# @file manifest.py
+#
+# Sample manifests for the batch modes of the SparkFuse scripts. Kept apart
+# from the genomecov reader so that scripts which only need the manifest do
+# not import numpy.
+
+import os
+
+"""
+Reads a sample manifest: one input filepath per line, optionally
+preceded by a sample name and a tab. Blank lines and lines starting with
+'#' are skipped, relative paths are taken relative to the manifest, and
+unnamed samples are named after their file. Returns (name, filepath) pairs.
+"""
+def read_manifest(filepath):
+    samples = []
+    directory = os.path.dirname(os.path.abspath(filepath))
+    with open(filepath, 'r') as filein:
+        for line in filein:
+            line = line.strip()
+            if len(line) and not line.startswith('#'):
+                line = [x.strip() for x in line.split('\t')]
+                if len(line) == 1:
+                    line = [os.path.basename(line[0])] + line
+                samples.append((line[0], os.path.join(directory, line[1])))
+        filein.close()
+    return samples
+    # end read_manifest()
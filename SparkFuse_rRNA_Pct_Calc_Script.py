@@ -5,30 +5,447 @@
 #
 # Required inputs:
 # -i/--input 	The BAM file to process.
-# -b/--bed 		A BED file containing the rRNA region coordinates.
+# -b/--bed 		A BED file containing the rRNA region coordinates. Further
+# 				contamination categories (e.g. mitochondrial, globin) can be
+# 				added as -b label=path; each gets <LABEL>_READS and
+# 				<LABEL>_PERCENT lines, all counted in the same pass.
 # --samtools 	The filepath to the SAMtools executable (e.g. /path/to/bin/samtools).
-# --bedtools 	The filepath to the bedtools executable (e.g. /path/to/bin/bedtools)
+#
+# The alignments are streamed once through `samtools view` and each record is
+# tested against an in-memory index of the rRNA intervals. A record counts as
+# an rRNA read when it or its mate overlaps an rRNA interval, as with
+# bedtools pairtobed, so no name-sorted copy of the BAM is needed. The mate's
+# extent comes from its MC (mate CIGAR) tag, or its read length without one.
+# --bedtools is still accepted but no longer used.
+#
+# With --indexed, an indexed (.bai/.csi) BAM is instead queried for the rRNA
+# regions only, and the total read count is taken from `samtools idxstats`.
+#
+# For a quick estimate, --sample-fraction reads only a deterministic,
+# read-name-hashed fraction of the alignments (samtools view -s), and the
+# percentages are reported with Wilson confidence intervals. Estimates are
+# taken over read templates (pairs, or unpaired reads) rather than records,
+# since the mates of a pair are not independent of each other: each
+# <LABEL>_PERCENT is then the percent of the SAMPLED_TEMPLATES that fall in
+# the category. With --ci-width, reading stops as soon as every interval is
+# narrower than the given width in percentage points (not on
+# coordinate-sorted BAMs, whose early records are not a random sample).
+#
+# Batch mode: -m/--manifest lists many BAMs (optionally preceded by a sample
+# name and a tab). The interval indexes are built once and the BAMs are
+# processed by a pool of -p worker processes, each running samtools with
+# -@ extra decompression threads; one table with a row per BAM is written.
 
 import sys
 import os
+import re
+import math
+import bisect
 import argparse
 import subprocess
+import multiprocessing
+
+from SparkFuse_Manifest import read_manifest
+
+CIGAR_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# CIGAR operations that consume reference bases.
+REFERENCE_OPERATIONS = 'MDN=X'
+
+# Output label of a -b BED given without one.
+DEFAULT_LABEL = 'RRNA'
+
+# Regions passed to one `samtools view` region query.
+REGIONS_PER_QUERY = 1000
+
+# Normal quantile of the reported confidence intervals (95%).
+WILSON_Z = 1.96
+
+# Records read between checks of the --ci-width early stop.
+CI_CHECK_INTERVAL = 100000
+
+# SAM flags.
+FLAG_PAIRED = 0x1
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_FIRST_IN_PAIR = 0x40
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+def load_intervals(filepath):
+	# {chromosome: (starts, ends)} of the merged, sorted 0-based half-open
+	# intervals of a BED file.
+	intervals = {}
+	with open(filepath, 'r') as filein:
+		for line in filein:
+			line = line.strip().split('\t')
+			if len(line) < 3 or line[0].startswith(('#', 'track', 'browser')):
+				continue
+			if line[0] not in intervals:
+				intervals[line[0]] = []
+			intervals[line[0]].append((int(line[1]), int(line[2])))
+		filein.close()
+
+	index = {}
+	for chromosome, regions in intervals.items():
+		starts = []
+		ends = []
+		for start, end in sorted(regions):
+			if len(ends) and start <= ends[-1]:
+				ends[-1] = max(ends[-1], end)
+			else:
+				starts.append(start)
+				ends.append(end)
+		index[chromosome] = (starts, ends)
+	return index
+	# end load_intervals()
+
+def split_category(spec):
+	# (label, filepath) of a -b value given as path (rRNA) or label=path.
+	if '=' in spec and not os.path.isfile(spec):
+		label, filepath = spec.split('=', 1)
+		return label.upper(), os.path.abspath(filepath)
+	return DEFAULT_LABEL, os.path.abspath(spec)
+	# end split_category()
+
+def load_categories(specs):
+	# [(label, index)] for the -b values; each label names one output column.
+	categories = []
+	for spec in specs:
+		label, filepath = split_category(spec)
+		if label in [x[0] for x in categories]:
+			raise ValueError('Category label {0} is used more than once'.format(label))
+		categories.append((label, load_intervals(filepath)))
+	return categories
+	# end load_categories()
+
+def overlap_start(index, chromosome, start):
+	# First 0-based position from start on that lies in an indexed interval
+	# of the chromosome, or None. A span beginning at start overlaps the
+	# index when it reaches that position, so only spans that begin before
+	# an interval need their length worked out.
+	if chromosome not in index:
+		return None
+	starts, ends = index[chromosome]
+	i = bisect.bisect_right(ends, start)
+	if i == len(ends):
+		return None
+	return max(starts[i], start)
+	# end overlap_start()
+
+def reference_length(cigar):
+	length = 0
+	for count, operation in CIGAR_PATTERN.findall(cigar):
+		if operation in REFERENCE_OPERATIONS:
+			length += int(count)
+	return length
+	# end reference_length()
+
+def record_overlaps(index, fields):
+	# Whether a mapped SAM record itself overlaps the index. The CIGAR is
+	# parsed only when the record starts short of an interval.
+	if int(fields[1]) & FLAG_UNMAPPED:
+		return False
+	start = int(fields[3]) - 1
+	first = overlap_start(index, fields[2], start)
+	if first is None:
+		return False
+	return first == start or start + reference_length(fields[5]) > first
+	# end record_overlaps()
+
+def is_rrna_record(index, fields):
+	# Whether a SAM record or, for a paired read, its mate overlaps the index.
+	if record_overlaps(index, fields):
+		return True
+	flag = int(fields[1])
+	if flag & FLAG_PAIRED and not flag & FLAG_MATE_UNMAPPED:
+		return mate_overlaps(index, fields)
+	return False
+	# end is_rrna_record()
+
+def mate_overlaps(index, fields):
+	# Whether the mate of a paired SAM record overlaps the index.
+	chromosome = fields[2] if fields[6] == '=' else fields[6]
+	start = int(fields[7]) - 1
+	first = overlap_start(index, chromosome, start)
+	if first is None:
+		return False
+	if first == start:
+		return True
+	for tag in fields[11:]:
+		if tag.startswith('MC:Z:'):
+			length = reference_length(tag[5:])
+			break
+	else:
+		length = len(fields[9]) if fields[9] != '*' else reference_length(fields[5])
+	return start + length > first
+	# end mate_overlaps()
+
+def thread_arguments(threads):
+	# samtools options for extra (de)compression threads.
+	if threads:
+		return ['-@', str(threads)]
+	return []
+	# end thread_arguments()
+
+def wilson_interval(successes, trials, z=WILSON_Z):
+	# Wilson score interval of a binomial proportion.
+	if trials == 0:
+		return 0.0, 1.0
+	p = float(successes) / trials
+	denominator = 1 + z * z / trials
+	center = (p + z * z / (2 * trials)) / denominator
+	half_width = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+	return max(center - half_width, 0.0), min(center + half_width, 1.0)
+	# end wilson_interval()
+
+def is_coordinate_sorted(samtools_path, input_bam):
+	header = subprocess.Popen([samtools_path, 'view', '-H', input_bam],
+		stdout=subprocess.PIPE, universal_newlines=True).communicate()[0]
+	for line in header.splitlines():
+		if line.startswith('@HD'):
+			return 'SO:coordinate' in line.split('\t')
+	return False
+	# end is_coordinate_sorted()
+
+"""
+Streams the records of the BAM once and returns the total count, the
+count of each of the (label, index) categories, the same two counts over
+read templates, and whether reading stopped early. A template is counted
+once, at its primary first-in-pair (or unpaired) record. With a
+fraction, samtools keeps that share of read names (hashed with the seed,
+so mates stay together and reruns agree). With a ci_width, reading stops
+once the Wilson interval of every category, over templates, is narrower
+than that fraction.
+"""
+def count_rrna_reads(samtools_path, input_bam, categories, fraction=None, seed=0, ci_width=None, threads=0):
+	read_count = 0
+	category_reads = [0] * len(categories)
+	template_count = 0
+	category_templates = [0] * len(categories)
+	command = [samtools_path, 'view'] + thread_arguments(threads)
+	if fraction is not None:
+		command += ['-s', '{0}{1}'.format(seed, '{0:.6f}'.format(fraction)[1:])]
+	process = subprocess.Popen(command + [input_bam],
+		stdout=subprocess.PIPE, universal_newlines=True, bufsize=1 << 20)
+	stopped = False
+	for line in process.stdout:
+		read_count += 1
+		fields = line.rstrip('\n').split('\t')
+		flag = int(fields[1])
+		template = not flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY) and (
+			not flag & FLAG_PAIRED or flag & FLAG_FIRST_IN_PAIR)
+		if template:
+			template_count += 1
+		for c, (label, index) in enumerate(categories):
+			if is_rrna_record(index, fields):
+				category_reads[c] += 1
+				if template:
+					category_templates[c] += 1
+		if ci_width is not None and read_count % CI_CHECK_INTERVAL == 0:
+			widths = []
+			for templates in category_templates:
+				lower, upper = wilson_interval(templates, template_count)
+				widths.append(upper - lower)
+			if max(widths) < ci_width:
+				stopped = True
+				process.terminate()
+				break
+	process.stdout.close()
+	if process.wait() != 0 and not stopped:
+		raise RuntimeError('samtools view failed on {0}.'.format(input_bam))
+	return read_count, category_reads, template_count, category_templates, stopped
+	# end count_rrna_reads()
+
+def find_bam_index(input_bam):
+	for index_filepath in (input_bam + '.bai', os.path.splitext(input_bam)[0] + '.bai', input_bam + '.csi'):
+		if os.path.isfile(index_filepath):
+			return index_filepath
+	return None
+	# end find_bam_index()
+
+def index_read_count(samtools_path, input_bam):
+	# Mapped plus unmapped records over all references, from the BAM index.
+	response = subprocess.Popen([samtools_path, 'idxstats', input_bam],
+		stdout=subprocess.PIPE, universal_newlines=True).communicate()[0]
+	read_count = 0
+	for line in response.splitlines():
+		fields = line.split('\t')
+		if len(fields) >= 4:
+			read_count += int(fields[2]) + int(fields[3])
+	return read_count
+	# end index_read_count()
+
+"""
+Counts the reads of each (label, index) category from region queries of
+an indexed BAM. A record can be returned by more than one region, so
+records are deduplicated on (name, flag, chromosome, position). A record
+counts for a category when it lies in one of the category's regions, or
+when it is unmapped and placed at a mate that does. A primary paired
+record whose mate lies outside the category's regions also stands for
+that mate; secondary and supplementary records do not, as their mate is
+the same primary record. Secondary and supplementary alignments of such
+mates are not seen, so counts can fall slightly below those of
+count_rrna_reads().
+"""
+def count_rrna_reads_indexed(samtools_path, input_bam, categories, threads=0):
+	merged = {}
+	for label, index in categories:
+		for chromosome, (starts, ends) in index.items():
+			if chromosome not in merged:
+				merged[chromosome] = []
+			merged[chromosome].extend(zip(starts, ends))
+	regions = []
+	for chromosome in sorted(merged.keys()):
+		for start, end in sorted(set(merged[chromosome])):
+			regions.append('{0}:{1}-{2}'.format(chromosome, start + 1, end))
+
+	seen = set()
+	category_reads = [0] * len(categories)
+	for i in range(0, len(regions), REGIONS_PER_QUERY):
+		process = subprocess.Popen([samtools_path, 'view'] + thread_arguments(threads) + [input_bam] + regions[i:i + REGIONS_PER_QUERY],
+			stdout=subprocess.PIPE, universal_newlines=True, bufsize=1 << 20)
+		for line in process.stdout:
+			fields = line.rstrip('\n').split('\t')
+			key = tuple(fields[:4])
+			if key in seen:
+				continue
+			seen.add(key)
+			flag = int(fields[1])
+			paired = flag & FLAG_PAIRED and not flag & FLAG_MATE_UNMAPPED
+			primary = not flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY)
+			for c, (label, index) in enumerate(categories):
+				if record_overlaps(index, fields):
+					category_reads[c] += 1
+					if paired and primary and not mate_overlaps(index, fields):
+						category_reads[c] += 1
+				elif flag & FLAG_UNMAPPED and paired and mate_overlaps(index, fields):
+					category_reads[c] += 1
+		process.stdout.close()
+		if process.wait() != 0:
+			raise RuntimeError('samtools view failed on {0}.'.format(input_bam))
+	return index_read_count(samtools_path, input_bam), category_reads
+	# end count_rrna_reads_indexed()
+
+def measure_bam(samtools_path, input_bam, categories, indexed=False, fraction=None, seed=0,
+		ci_width=None, threads=0):
+	# (total, per-category) read counts of one BAM in the chosen mode, plus
+	# the (total, per-category) template counts when the BAM was streamed.
+	if indexed:
+		read_count, category_reads = count_rrna_reads_indexed(samtools_path, input_bam, categories, threads)
+		return read_count, category_reads, None
+	if ci_width is not None and is_coordinate_sorted(samtools_path, input_bam):
+		print('Warning: {0} is coordinate-sorted, so its first records are not a random '.format(input_bam) +
+			'sample; reading it to the end instead of stopping at --ci-width.')
+		ci_width = None
+	read_count, category_reads, template_count, category_templates, stopped = count_rrna_reads(
+		samtools_path, input_bam, categories, fraction, seed, ci_width, threads)
+	if stopped:
+		print('{0}: confidence intervals reached --ci-width after {1} reads.'.format(input_bam, read_count))
+	return read_count, category_reads, (template_count, category_templates)
+	# end measure_bam()
+
+def result_fields(categories, read_count, category_reads, estimate=False, templates=None):
+	# (name, value) output fields. Estimates report the reads and templates
+	# actually examined, and each percentage and its confidence interval
+	# over the (total, per-category) template counts.
+	fields = []
+	if estimate:
+		fields.append(('SAMPLED_READS', read_count))
+		fields.append(('SAMPLED_TEMPLATES', templates[0]))
+	for c, ((label, index), reads) in enumerate(zip(categories, category_reads)):
+		fields.append(('{0}_READS'.format(label), reads))
+		if estimate:
+			fields.append(('{0}_PERCENT'.format(label), (100.0 * templates[1][c]) / templates[0]))
+			lower, upper = wilson_interval(templates[1][c], templates[0])
+			fields.append(('{0}_PERCENT_CI_LOWER'.format(label), 100.0 * lower))
+			fields.append(('{0}_PERCENT_CI_UPPER'.format(label), 100.0 * upper))
+		else:
+			fields.append(('{0}_PERCENT'.format(label), (100.0 * reads) / read_count))
+	return fields
+	# end result_fields()
+
+
+# Interval indexes and options shared with the batch worker processes.
+_worker_state = {}
+
+def _init_worker(samtools_path, categories, options):
+	_worker_state['samtools_path'] = samtools_path
+	_worker_state['categories'] = categories
+	_worker_state['options'] = options
+	# end _init_worker()
+
+def _batch_worker(sample):
+	name, input_bam = sample
+	read_count, category_reads, templates = measure_bam(_worker_state['samtools_path'], input_bam,
+		_worker_state['categories'], **_worker_state['options'])
+	return name, read_count, category_reads, templates
+	# end _batch_worker()
+
+"""
+Measures every (name, BAM) sample with a pool of worker processes
+sharing one set of interval indexes, and writes one table with
+a row per sample and a column per result_fields() field.
+"""
+def batch_rrna_reads(samtools_path, samples, categories, filepath, processes=None, estimate=False, **options):
+	pool = multiprocessing.Pool(processes, initializer=_init_worker,
+		initargs=(samtools_path, categories, options))
+	try:
+		with open(filepath, 'w') as fileout:
+			header_written = False
+			for name, read_count, category_reads, templates in pool.imap(_batch_worker, samples):
+				fields = result_fields(categories, read_count, category_reads, estimate, templates)
+				if not header_written:
+					fileout.write('\t'.join(['SAMPLE'] + [x[0] for x in fields]) + '\n')
+					header_written = True
+				fileout.write('\t'.join([name] + [str(x[1]) for x in fields]) + '\n')
+			fileout.close()
+	finally:
+		pool.close()
+		pool.join()
+	return True
+	# end batch_rrna_reads()
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='rRNA Percent Calculation')
 	parser.add_argument('-i', '--input', help='Input file')
-	parser.add_argument('-b', '--bed', help='BED file')
+	parser.add_argument('-m', '--manifest',
+		help='Batch mode: file listing one BAM per line, optionally preceded by a sample name and a tab')
+	parser.add_argument('-p', '--processes', type=int, default=None,
+		help='BAMs processed at once in batch mode (default: one per CPU)')
+	parser.add_argument('-@', '--threads', type=int, default=0,
+		help='Extra samtools decompression threads per BAM')
+	parser.add_argument('-b', '--bed', action='append',
+		help='rRNA BED file, or label=path for another category. Repeat to count several categories')
 	parser.add_argument('-o', '--output', help='Output file')
 	parser.add_argument('--samtools', help='Path to samtools')
-	parser.add_argument('--bedtools', help='Path to bedtools')
+	parser.add_argument('--bedtools', help='Path to bedtools (no longer used)')
+	parser.add_argument('--indexed', action='store_true',
+		help='Query only the rRNA regions of the indexed BAM, and take the total read '
+		'count from its index')
+	parser.add_argument('--sample-fraction', type=float,
+		help='Estimate from this fraction (0-1) of read names, with confidence intervals')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the read name sampling')
+	parser.add_argument('--ci-width', type=float,
+		help='Stop once every 95%% confidence interval is narrower than this many '
+		'percentage points')
 	args = parser.parse_args(sys.argv[1:])
 
 
-	if args.input is None:
+	if args.manifest is not None:
+		manifest_filepath = os.path.abspath(args.manifest)
+		if os.path.isfile(manifest_filepath) is False:
+			print('Error: Manifest file {0} does not exist.'.format(manifest_filepath))
+			exit()
+		samples = read_manifest(manifest_filepath)
+	elif args.input is None:
 		print('Error: Input file not specified.')
 		exit()
 	else:
 		input_bam = os.path.abspath(args.input)
+		samples = [(os.path.basename(input_bam), input_bam)]
+
+	for name, input_bam in samples:
 		if os.path.isfile(input_bam) is False:
 			print('Error: Input file {0} does not exist.'.format(input_bam))
 			exit()
@@ -38,10 +455,16 @@ if __name__ == '__main__':
 		print('Error: BED file not specified.')
 		exit()
 	else:
-		bed_file_path = os.path.abspath(args.bed)
-		if os.path.isfile(bed_file_path) is False:
-			print('Error: BED file {0} does not exist.'.format(bed_file_path))
-			exit()
+		labels = []
+		for bed in args.bed:
+			label, bed_file_path = split_category(bed)
+			if os.path.isfile(bed_file_path) is False:
+				print('Error: BED file {0} does not exist.'.format(bed_file_path))
+				exit()
+			if label in labels:
+				print('Error: Category label {0} is used more than once!'.format(label))
+				exit()
+			labels.append(label)
 
 
 	if args.output is None:
@@ -61,51 +484,39 @@ if __name__ == '__main__':
 			exit()
 
 
-	if args.bedtools is None:
-		print('Error: Path to bedtools not specified.')
-		exit()
-	else:
-		bedtools_path = os.path.abspath(args.bedtools)
-		if os.path.isfile(bedtools_path) is False:
-			print('Error: bedtools not found at {0}'.format(bedtools_path))
-			exit()
-
-
-	# Generate filenames for the intermediate files.
-	name_sorted_prefix = os.path.basename(input_bam).replace('.bam', '.name_sorted')
-	name_sorted_prefix = input_bam.replace(os.path.basename(input_bam), name_sorted_prefix)
-	name_sorted_bam = name_sorted_prefix + '.bam'
-	name_sorted_intx = name_sorted_prefix + '.intx'
-
-	# Sort by name for bedtools
-	os.system('{0} sort -n {1} {2}'.format(samtools_path, input_bam, name_sorted_prefix))
+	if args.indexed:
+		for name, input_bam in samples:
+			if find_bam_index(input_bam) is None:
+				print('Error: No index (.bai/.csi) found for {0}.'.format(input_bam))
+				exit()
 
-	# BEDTools intersect BAM with rRNA.bed
-	os.system('{0} pairtobed -abam {1} -b {2} > {3}'.format(bedtools_path, name_sorted_bam, 
-		bed_file_path, name_sorted_intx))
 
+	estimate = args.sample_fraction is not None or args.ci_width is not None
+	if args.sample_fraction is not None and not 0 < args.sample_fraction < 1:
+		print('Error: Sample fraction must be between 0 and 1.')
+		exit()
+	if estimate and args.indexed:
+		print('Error: --sample-fraction and --ci-width cannot be combined with --indexed.')
+		exit()
 
-	# Get total read count using samtools flagstat
-	command = '{0} flagstat {1}'.format(samtools_path, input_bam)
-	response = subprocess.Popen([command], stdout=subprocess.PIPE, shell=True).communicate()[0].split('\t')
-	
-	# Total read count is the first word of the first line of the response
-	read_count = int(response[0].strip().split(' ')[0])
+	options = {
+		'indexed': args.indexed,
+		'fraction': args.sample_fraction,
+		'seed': args.seed,
+		'ci_width': args.ci_width / 100.0 if args.ci_width is not None else None,
+		'threads': args.threads,
+		}
 
-	# Get rRNA read count using samtools flagstat
-	command = '{0} flagstat {1}'.format(samtools_path, name_sorted_intx)
-	response = subprocess.Popen([command], stdout=subprocess.PIPE, shell=True).communicate()[0].split('\t')
-	
-	# Total read count is the first word of the first line of the response
-	rrna_reads = int(response[0].strip().split(' ')[0])
 
+	categories = load_categories(args.bed)
+	if args.manifest is not None:
+		batch_rrna_reads(samtools_path, samples, categories, output_filepath, args.processes, estimate, **options)
+		exit()
 
-	# Delete temporary files
-	os.remove(name_sorted_bam)
-	os.remove(name_sorted_intx)
+	read_count, category_reads, templates = measure_bam(samtools_path, samples[0][1], categories, **options)
 
 	# Write to output file
 	output = open(output_filepath, 'w')
-	output.write('RRNA_READS\t{0}'.format(rrna_reads) + '\n')
-	output.write('RRNA_PERCENT\t{0}'.format((100.0 * rrna_reads) / read_count) + '\n')
+	for name, value in result_fields(categories, read_count, category_reads, estimate, templates):
+		output.write('{0}\t{1}'.format(name, value) + '\n')
 	output.close()